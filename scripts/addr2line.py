@@ -18,19 +18,74 @@
 #
 # Copyright (C) 2017 ScyllaDB
 
+from array import array
+import asyncio
 import bisect
 import collections
+import concurrent.futures
+import gzip
+import io
+import json
+import mmap
+import os
+import queue
 import re
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import struct
 import sys
 import subprocess
+import threading
 from enum import Enum
-from functools import cache
 import time
-from typing import Any, Optional, TypeVar, Union, cast
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    TextIO,
+    TypeVar,
+    Union,
+    cast,
+)
+
+try:
+    from elftools.elf.elffile import ELFFile
+    from elftools.common.exceptions import ELFError
+except ImportError:
+    ELFFile = None  # type: ignore[misc,assignment]
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
 
 # special binary path/module indicating that the address is from the kernel
 KERNEL_MODULE = '<kernel>'
 
+# the kernel symbols of the local host, used unless another kallsyms is given
+DEFAULT_KALLSYMS = '/proc/kallsyms'
+
+# the executable of frames without a path, when using an index of executables
+# and none was selected yet
+UNKNOWN_EXECUTABLE = '<unknown executable>'
+
+# the default regex selecting an executable from an index by its Build-ID,
+# e.g., from scylla's "Scylla version ... with build-id <id> starting ..."
+DEFAULT_SELECT_RE = r'(?i:build[-_ ]?id)[:=\s]+(?P<key>[0-9a-f]{16,})'
+
+# how long the long running modes (following a file, serving) keep an unused
+# module resolver before closing it, in seconds
+DEFAULT_MAX_IDLE = 300.0
+
 
 T = TypeVar('T')
 
@@ -41,6 +96,394 @@ def notNone(o: Optional[T]) -> T:
     return o
 
 
+def _read_elf_header(f: BinaryIO) -> Optional[tuple[str, bool, int, int, int, int, int, int]]:
+    """Reads the ELF header of an open file.
+
+    Returns (endian, is64, phoff, shoff, phentsize, phnum, shentsize, shnum),
+    or None if the file is not an ELF file.
+    """
+    ident = f.read(16)
+    if len(ident) < 16 or ident[:4] != b'\x7fELF':
+        return None
+    is64 = ident[4] == 2
+    endian = '<' if ident[5] == 1 else '>'
+    if is64:
+        phoff, shoff = struct.unpack(endian + '16xQQ', f.read(32))
+        f.seek(54)
+    else:
+        phoff, shoff = struct.unpack(endian + '12xII', f.read(20))
+        f.seek(42)
+    phentsize, phnum, shentsize, shnum = struct.unpack(endian + 'HHHH', f.read(8))
+    return endian, is64, phoff, shoff, phentsize, phnum, shentsize, shnum
+
+
+def _read_elf_sections(
+    f: BinaryIO, endian: str, is64: bool, shoff: int, shentsize: int, shnum: int
+) -> list[tuple[int, int, int, int, int]]:
+    """Returns (sh_type, sh_offset, sh_size, sh_link, sh_entsize) of the sections of an ELF file."""
+    sections: list[tuple[int, int, int, int, int]] = []
+    for i in range(shnum):
+        f.seek(shoff + i * shentsize)
+        if is64:
+            _, sh_type, _, _, sh_offset, sh_size, sh_link, _, _, sh_entsize = struct.unpack(
+                endian + 'IIQQQQIIQQ', f.read(64)
+            )
+        else:
+            _, sh_type, _, _, sh_offset, sh_size, sh_link, _, _, sh_entsize = struct.unpack(
+                endian + 'IIIIIIIIII', f.read(40)
+            )
+        sections.append((sh_type, sh_offset, sh_size, sh_link, sh_entsize))
+    return sections
+
+
+def elf_build_id(path: str) -> Optional[str]:
+    """Returns the GNU Build-ID of an ELF file as a hex string, or None if it has none."""
+    try:
+        with open(path, 'rb') as f:
+            header = _read_elf_header(f)
+            if header is None:
+                return None
+            endian, is64, phoff, shoff, phentsize, phnum, shentsize, shnum = header
+
+            # collect (offset, size) of all the note segments and sections
+            notes: list[tuple[int, int]] = []
+            for i in range(phnum):
+                f.seek(phoff + i * phentsize)
+                if is64:
+                    p_type, _, p_offset, _, _, p_filesz = struct.unpack(
+                        endian + 'IIQQQQ', f.read(40)
+                    )
+                else:
+                    p_type, p_offset, _, _, p_filesz = struct.unpack(endian + 'IIIII', f.read(20))
+                if p_type == 4:  # PT_NOTE
+                    notes.append((p_offset, p_filesz))
+            for sh_type, sh_offset, sh_size, _, _ in _read_elf_sections(
+                f, endian, is64, shoff, shentsize, shnum
+            ):
+                if sh_type == 7:  # SHT_NOTE
+                    notes.append((sh_offset, sh_size))
+
+            for offset, size in notes:
+                f.seek(offset)
+                data = f.read(size)
+                pos = 0
+                while pos + 12 <= len(data):
+                    namesz, descsz, n_type = struct.unpack_from(endian + 'III', data, pos)
+                    name_start = pos + 12
+                    desc_start = name_start + ((namesz + 3) & ~3)
+                    if n_type == 3 and data[name_start : name_start + namesz] == b'GNU\0':
+                        return data[desc_start : desc_start + descsz].hex()
+                    pos = desc_start + ((descsz + 3) & ~3)
+    except (OSError, struct.error):
+        pass
+    return None
+
+
+def follow_file(
+    path: str, poll_interval: float = 0.5, from_start: bool = False
+) -> Iterator[Optional[str]]:
+    """Yields the lines appended to a file, like `tail -F`, forever.
+
+    Reading starts at the end of the file, unless from_start is True. When
+    the file is rotated (the path is replaced by a new file) the new file is
+    read from its start, and when it is truncated it is read again from its
+    start. None is yielded after each poll_interval seconds without new
+    complete lines, so that the caller can act on timeouts.
+    """
+    f = open(path, 'rb')
+    if not from_start:
+        f.seek(0, os.SEEK_END)
+    partial = b''
+    try:
+        while True:
+            line = f.readline()
+            if line.endswith(b'\n'):
+                yield (partial + line).decode(errors='replace')
+                partial = b''
+                continue
+            partial += line
+
+            # at the end of the file, check whether it was rotated or truncated
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None  # in the middle of a rotation, wait for the new file
+            if st is not None:
+                current = os.fstat(f.fileno())
+                if (st.st_dev, st.st_ino) != (current.st_dev, current.st_ino):
+                    if partial:
+                        yield partial.decode(errors='replace') + '\n'
+                        partial = b''
+                    f.close()
+                    f = open(path, 'rb')
+                    continue
+                if st.st_size < f.tell():
+                    partial = b''
+                    f.seek(0)
+                    continue
+            yield None
+            time.sleep(poll_interval)
+    finally:
+        f.close()
+
+
+def is_executable_index(path: str) -> bool:
+    return os.path.isdir(path) or path.endswith('.json')
+
+
+def load_executable_index(path: str) -> dict[str, str]:
+    """Loads an index of executables, keyed by Build-ID or any other string (e.g., a version).
+
+    The index is either a directory, whose ELF files (searched recursively)
+    are keyed by their Build-ID, or a JSON file holding an object mapping
+    keys to executable paths, relative to the directory of the file, which
+    are keyed by their Build-ID too. A "default" key names the executable to
+    use until one is selected.
+    """
+    index: dict[str, str] = {}
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                binary = os.path.join(root, name)
+                build_id = elf_build_id(binary)
+                # for duplicates, e.g., an executable and its separate debug info, keep the first
+                if build_id is not None and build_id not in index:
+                    index[build_id] = binary
+        return index
+    with open(path, 'r') as f:
+        entries = json.load(f)
+    if not isinstance(entries, dict):
+        raise ValueError(f'{path}: the executable index must be a JSON object')
+    base = os.path.dirname(path)
+    for key, binary in entries.items():
+        index[str(key).strip()] = os.path.join(base, binary)
+    # the executables can be selected by their Build-ID as well
+    for binary in set(index.values()):
+        build_id = elf_build_id(binary)
+        if build_id is not None:
+            index.setdefault(build_id, binary)
+    return index
+
+
+_WHITESPACE = frozenset(b' \t\n\r\x0b\x0c')
+
+
+def normalize_byte_lines(lines: Iterable[bytes]) -> Iterator[bytes]:
+    """Yields lines stripped of surrounding whitespace and ending with a newline.
+
+    The byte counterpart of the `line.strip() + '\n'` applied to text lines,
+    which only allocates for lines which need to be changed.
+    """
+    ws = _WHITESPACE
+    for line in lines:
+        if len(line) < 2 or line[-1] != 10 or line[0] in ws or line[-2] in ws:
+            line = line.strip() + b'\n'
+        yield line
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# the size of the chunks handed over by the background decompression
+DECOMPRESS_CHUNK_SIZE = 1 << 20
+# the number of decompressed chunks buffered ahead of the consumer
+DECOMPRESS_QUEUE_SIZE = 8
+
+
+def _background_chunks(read: Callable[[int], bytes], close: Callable[[], Any]) -> Iterator[bytes]:
+    """Yields the chunks returned by read() until the end of its input, then calls close().
+
+    read() is called on a background thread, so that decompression (zlib and
+    zstd release the GIL) overlaps with the processing of the chunks.
+    """
+    chunks: queue.Queue = queue.Queue(maxsize=DECOMPRESS_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                chunk = read(DECOMPRESS_CHUNK_SIZE)
+                chunks.put(chunk)
+                if not chunk:
+                    return
+        except BaseException as e:
+            chunks.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        stop.set()
+        # unblock the reader if the consumer stopped early
+        while thread.is_alive():
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+        close()
+
+
+def _chunk_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Yields the lines of a stream split into arbitrary chunks."""
+    partial = b''
+    for chunk in chunks:
+        lines = io.BytesIO(partial + chunk).readlines()
+        partial = lines.pop() if not lines[-1].endswith(b'\n') else b''
+        yield from lines
+    if partial:
+        yield partial
+
+
+def _zstd_chunks(f: BinaryIO) -> Iterator[bytes]:
+    if zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            f, read_across_frames=True, closefd=False
+        )
+        return _background_chunks(reader.read, reader.close)
+    zstd = shutil.which('zstd')
+    if zstd is None:
+        raise RuntimeError('reading zstd compressed logs requires the zstandard module or zstd')
+    proc = subprocess.Popen([zstd, '-dcq'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    stdin = notNone(proc.stdin)
+
+    # feed the data already buffered by f too, so don't hand over its file descriptor
+    def feed():
+        try:
+            shutil.copyfileobj(f, stdin, DECOMPRESS_CHUNK_SIZE)
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    def close():
+        proc.kill()
+        notNone(proc.stdout).close()
+        feeder.join()
+        proc.wait()
+
+    return _background_chunks(notNone(proc.stdout).read, close)
+
+
+def read_log_lines(source: Union[str, BinaryIO]) -> Iterator[bytes]:
+    """Yields the lines of a log, given by its path or as a binary file, as bytes.
+
+    gzip and zstd compressed logs are decompressed transparently, detected by
+    their magic bytes. Decompression runs in the background (a thread, or a
+    zstd process without the zstandard module), overlapping with processing
+    the lines. Uncompressed regular files given by their path are memory mapped.
+    """
+    f = open(source, 'rb') if isinstance(source, str) else source
+    try:
+        peek = getattr(f, 'peek', None)
+        magic = peek(len(ZSTD_MAGIC))[: len(ZSTD_MAGIC)] if peek is not None else b''
+        if magic.startswith(GZIP_MAGIC):
+            gz = gzip.GzipFile(fileobj=f, mode='rb')
+            yield from _chunk_lines(_background_chunks(gz.read, gz.close))
+            return
+        if magic == ZSTD_MAGIC:
+            yield from _chunk_lines(_zstd_chunks(f))
+            return
+        if not isinstance(source, str):
+            yield from f
+            return
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty, or not mappable
+            yield from f
+            return
+        with mm:
+            yield from iter(mm.readline, b'')
+    finally:
+        if isinstance(source, str):
+            f.close()
+
+
+def read_byte_lines(source: Union[str, BinaryIO]) -> Iterator[bytes]:
+    """Yields the normalized lines of a log as bytes, see normalize_byte_lines() and read_log_lines()."""
+    return normalize_byte_lines(read_log_lines(source))
+
+
+def default_symbol_cache_path() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'seastar-addr2line', 'symbols.sqlite')
+
+
+class SymbolCache:
+    """A persistent cache of resolved addresses, stored in an sqlite database.
+
+    Entries are keyed by the Build-ID of the module the address belongs to, so
+    they remain valid for as long as the binary does, whatever its path. The
+    variant separates outputs of differently configured resolvers (e.g.,
+    binutils vs llvm addr2line, or concise names) for the same binary.
+    """
+
+    # stay below the default SQLITE_MAX_VARIABLE_NUMBER of older sqlite versions
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self, path: str, variant: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._variant = variant
+        # accesses are serialized by the users, but may come from different
+        # threads, e.g., in ResolverServer
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS symbols ('
+            ' build_id TEXT NOT NULL, variant TEXT NOT NULL, address TEXT NOT NULL,'
+            ' resolved TEXT NOT NULL, PRIMARY KEY (build_id, variant, address)'
+            ') WITHOUT ROWID'
+        )
+        self._db.commit()
+
+    @staticmethod
+    def _key(address: str) -> str:
+        # normalize, so that e.g. 0x00001234 and 0x1234 share an entry
+        return f'{int(address, 16):x}'
+
+    def lookup(self, build_id: str, addresses: Sequence[str]) -> dict[str, str]:
+        """Returns the cached resolutions of the given addresses, keyed by address."""
+        keys = {self._key(address): address for address in addresses}
+        key_list = list(keys)
+        res: dict[str, str] = {}
+        for i in range(0, len(key_list), self.QUERY_BATCH_SIZE):
+            batch = key_list[i : i + self.QUERY_BATCH_SIZE]
+            rows = self._db.execute(
+                'SELECT address, resolved FROM symbols WHERE build_id = ? AND variant = ?'
+                f' AND address IN ({",".join("?" * len(batch))})',
+                [build_id, self._variant, *batch],
+            )
+            for key, resolved in rows:
+                res[keys[key]] = resolved
+        return res
+
+    def store(self, build_id: str, resolved: dict[str, str]):
+        self._db.executemany(
+            'INSERT OR REPLACE INTO symbols VALUES (?, ?, ?, ?)',
+            [
+                (build_id, self._variant, self._key(address), res)
+                for address, res in resolved.items()
+            ],
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
 class Addr2Line:
 
     # Matcher for a line that appears at the end a single decoded
@@ -60,6 +503,12 @@ class Addr2Line:
         r"(,\n)"  # llvm-addr2line pattern for LLVM 17 and older
     )
 
+    # Maximum number of addresses written to the pipe before reading back
+    # their resolutions. The pending input must stay well below the pipe
+    # buffer size: addr2line stops consuming input when its output pipe is
+    # full, so writing an unbounded batch could deadlock both processes.
+    BATCH_SIZE = 256
+
     def __init__(
         self,
         parent: 'BacktraceResolver',
@@ -69,7 +518,19 @@ class Addr2Line:
     ):
         self._parent = parent
         self._binary = binary
+        self._concise = concise
+        self._cmd_path = cmd_path
+        # the processes are only started on the first lookup
+        self._input_proc: Optional[subprocess.Popen[str]] = None
+        self._output_proc: Optional[subprocess.Popen[str]] = None
+        self._missing = False
+
+    def _start(self):
+        start = self._parent.timing_now()
+        self._spawn()
+        self._parent.stats.phases['addr2line spawn'] += self._parent.timing_now() - start
 
+    def _spawn(self):
         # Print warning if binary has no debug info according to `file`.
         # Note: no message is printed for system errors as they will be
         # printed also by addr2line later on.
@@ -78,7 +539,7 @@ class Addr2Line:
         if s.find('ELF') >= 0 and s.find('debug_info', len(self._binary)) < 0:
             print('{}'.format(s))
 
-        args = [cmd_path, f"-{'C' if not concise else ''}fpia", "-e", self._binary]
+        args = [self._cmd_path, f"-{'C' if not self._concise else ''}fpia", "-e", self._binary]
         self._parent.debug(f"Addr2line invoking: {' '.join(args)}")
         self._input_proc = subprocess.Popen(
             args,
@@ -86,7 +547,7 @@ class Addr2Line:
             stdout=subprocess.PIPE,
             universal_newlines=True,
         )
-        if concise:
+        if self._concise:
             self._output_proc = subprocess.Popen(
                 ["c++filt", "-p"],
                 stdin=self._input_proc.stdout,
@@ -105,15 +566,38 @@ class Addr2Line:
         res = self._output.readline()
         self._missing = res == ''
 
+    def close(self):
+        """Terminates the processes, if started. They are restarted on the next lookup."""
+        if self._input_proc is None:
+            return
+        self._parent.debug(f'Addr2line closing resolver for {self._binary}')
+        procs = [self._input_proc]
+        if self._output_proc is not self._input_proc:
+            procs.append(notNone(self._output_proc))
+        try:
+            self._input.close()
+        except BrokenPipeError:
+            pass
+        for proc in procs:
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            if proc.stdout:
+                proc.stdout.close()
+        self._input_proc = None
+        self._output_proc = None
+
     @property
     def _input(self):
         """Returns the input stream for the process/pipe."""
-        return notNone(self._input_proc.stdin)
+        return notNone(notNone(self._input_proc).stdin)
 
     @property
     def _output(self):
         """Returns the output stream for the process/pipe."""
-        return notNone(self._output_proc.stdout)
+        return notNone(notNone(self._output_proc).stdout)
 
     def _read_resolved_address(self):
         first = self._output.readline()
@@ -129,99 +613,538 @@ class Addr2Line:
             res += line
         return res
 
-    def __call__(self, address: str):
+    def start(self):
+        """Starts the processes, if not started yet, rather than on the next lookup."""
+        if self._input_proc is None and not self._missing:
+            self._start()
+
+    def resolve_many(self, addresses: Sequence[str]) -> list[str]:
+        """Resolves a batch of addresses with one pipe round-trip per BATCH_SIZE addresses."""
+        self.start()
         if self._missing:
-            return " ".join([self._binary, address, '\n'])
-        # We trigger a dummy "invalid" address printout after the address we are interested in
-        # which we can look for in _read_address
-        inputline = address + '\n,\n'
-        self._parent.debug('Add2Line sending input to stdin:', inputline)
-        self._input.write(inputline)
-        self._input.flush()
-        return self._read_resolved_address()
+            return [" ".join([self._binary, address, '\n']) for address in addresses]
+        res: list[str] = []
+        for i in range(0, len(addresses), self.BATCH_SIZE):
+            batch = addresses[i : i + self.BATCH_SIZE]
+            # We trigger a dummy "invalid" address printout after each address we are
+            # interested in, which we use in _read_resolved_address to split the output
+            inputlines = ''.join(f'{address}\n,\n' for address in batch)
+            self._parent.debug('Add2Line sending input to stdin:', inputlines)
+            self._input.write(inputlines)
+            self._input.flush()
+            res.extend(self._read_resolved_address() for _ in batch)
+        return res
 
+    def __call__(self, address: str):
+        return self.resolve_many([address])[0]
 
-class KernelResolver:
-    """A resolver for kernel addresses which tries to read from /proc/kallsyms."""
 
+class KernelResolver:
+    """A resolver for kernel addresses.
+
+    Symbols are read from /proc/kallsyms by default, or from a vmlinux image or
+    a System.map file, e.g., to decode kernel callstacks offline on another
+    machine. When reading from a vmlinux or System.map, the addresses may need
+    to be adjusted by the KASLR offset of the kernel which produced them: it is
+    either given explicitly, or detected by comparing the address of the _text
+    symbol in an explicitly given kallsyms (e.g., a copy saved from the crashing
+    host) with the one in the symbol file. The kallsyms of the local host tells
+    nothing about the kernel which produced the addresses, so without either,
+    no offset is assumed, with a warning.
+
+    The symbol table is kept in sorted array columns, and lookups are binary
+    searches.
+    """
+
+    # Size assumed for the last symbol when symbol sizes are not known, as
+    # kallsyms and System.map don't include them.
     LAST_SYMBOL_MAX_SIZE = 1024
 
-    def __init__(self, parent: 'BacktraceResolver', kallsyms: str = '/proc/kallsyms'):
-        syms: list[tuple[int, str]] = []
-        ksym_re = re.compile(r'(?P<addr>[0-9a-f]+) (?P<type>.+) (?P<name>\S+)')
-        warnings_left = 10
+    # symbol types (st_info & 0xf) of the vmlinux symbols we resolve to
+    STT_NOTYPE = 0
+    STT_FUNC = 2
 
+    def __init__(
+        self,
+        parent: 'BacktraceResolver',
+        kallsyms: Optional[str] = None,
+        vmlinux: Optional[str] = None,
+        offset: Optional[int] = None,
+    ):
+        self._parent = parent
         self.error = None
 
+        source = vmlinux if vmlinux is not None else kallsyms or DEFAULT_KALLSYMS
         try:
-            f = open(kallsyms, 'r')
-        except OSError as e:
-            self.error = f'Cannot open {kallsyms}: {e}'
+            with open(source, 'rb') as f:
+                if f.read(4) == b'\x7fELF':
+                    f.seek(0)
+                    addrs, sizes, names = self._read_elf_symbols(f)
+                else:
+                    f.seek(0)
+                    addrs, sizes, names = self._read_symbol_map(source, f)
+        except (OSError, struct.error) as e:
+            self.error = f'Cannot read {source}: {e}'
             print(self.error)
             return
 
-        try:
-            for line in f:
-                m = ksym_re.match(line)
-                if not m:
-                    if warnings_left > 0:  # don't spam too much
-                        print(
-                            f'WARNING: {kallsyms} regex match failure: {line.strip()}',
-                            file=sys.stdout,
-                        )
-                        warnings_left -= 1
-                else:
-                    syms.append((int(m.group('addr'), 16), m.group('name')))
-        finally:
-            f.close()
-
-        if not syms:
-            # make empty kallsyms (?) an error so we can assum len >= 1 below
-            self.error = 'kallsyms was empty'
+        if not addrs:
+            # make an empty symbol table an error so we can assume len >= 1 below
+            self.error = f'{source} has no symbols'
             print(self.error)
             return
 
-        syms.sort()
-
-        if syms[-1][0] == 0:
+        if not any(addrs):
             # zero values for all symbols means that kptr_restrict blocked you
             # from seeing the kernel symbol addresses
             print('kallsyms is restricted, set /proc/sys/kernel/kptr_restrict to 0 to decode')
             self.error = 'kallsyms is restricted'
             return
 
-        # split because bisect can't take a key func before 3.10
-        self.sym_addrs: tuple[int]
-        self.sym_names: tuple[str]
-        self.sym_addrs, self.sym_names = zip(*syms)  # type: ignore
+        if offset is None:
+            offset = 0
+            if vmlinux is not None and kallsyms is not None:
+                offset = self._detect_offset(kallsyms, addrs, names)
+            elif vmlinux is not None:
+                print(
+                    'WARNING: assuming no KASLR offset for the kernel addresses resolved with'
+                    f' {vmlinux}, pass --kernel-offset, or --kallsyms of the host they come from'
+                )
+        self.offset = offset
+        self._sort_symbols(addrs, sizes, names)
+        parent.debug(f'Kernel symbols: {len(self.sym_addrs)} from {source}, offset 0x{offset:x}')
+
+    def _read_symbol_map(self, path: str, f: BinaryIO) -> tuple[array, array, list[str]]:
+        """Reads symbols from a kallsyms or System.map file: "address type name [module]" lines.
+
+        Symbol sizes are not known, they are filled in by _sort_symbols().
+        """
+        addrs = array('Q')
+        names: list[str] = []
+        warnings_left = 10
+        for line in f:
+            fields = line.split()
+            try:
+                addr = int(fields[0], 16)
+                name = fields[2].decode()
+            except (IndexError, ValueError):
+                if warnings_left > 0:  # don't spam too much
+                    print(
+                        f'WARNING: {path} parse failure: {line.decode(errors="replace").strip()}',
+                        file=sys.stdout,
+                    )
+                    warnings_left -= 1
+                continue
+            addrs.append(addr)
+            names.append(name)
+        return addrs, array('Q', bytes(8 * len(addrs))), names
+
+    def _read_elf_symbols(self, f: BinaryIO) -> tuple[array, array, list[str]]:
+        """Reads the function symbols, with their sizes, from the symbol table of a vmlinux."""
+        header = _read_elf_header(f)
+        assert header is not None
+        endian, is64, _, shoff, _, _, shentsize, shnum = header
+        sections = _read_elf_sections(f, endian, is64, shoff, shentsize, shnum)
+        addrs = array('Q')
+        sizes = array('Q')
+        names: list[str] = []
+        for sh_type, sh_offset, sh_size, sh_link, sh_entsize in sections:
+            if sh_type != 2:  # SHT_SYMTAB
+                continue
+            f.seek(sections[sh_link][1])
+            strtab = f.read(sections[sh_link][2])
+            f.seek(sh_offset)
+            data = f.read(sh_size - sh_size % sh_entsize)
+            if is64:
+                # st_name, st_info, st_other, st_shndx, st_value, st_size
+                symbols = struct.iter_unpack(endian + 'IBBHQQ', data)
+            else:
+                # st_name, st_value, st_size, st_info, st_other, st_shndx
+                symbols = (
+                    (name, info, other, shndx, value, size)
+                    for name, value, size, info, other, shndx in struct.iter_unpack(
+                        endian + 'IIIBBH', data
+                    )
+                )
+            for st_name, st_info, _, st_shndx, st_value, st_size in symbols:
+                if st_shndx == 0 or st_name == 0:  # undefined or unnamed
+                    continue
+                if st_info & 0xF not in (self.STT_NOTYPE, self.STT_FUNC):
+                    continue
+                addrs.append(st_value)
+                sizes.append(st_size)
+                names.append(strtab[st_name : strtab.index(b'\0', st_name)].decode())
+        return addrs, sizes, names
+
+    def _sort_symbols(self, addrs: array, sizes: array, names: list[str]):
+        """Sorts the symbols by address, and stores them in the sym_* columns.
+
+        Of several symbols at the same address (aliases), only the one with the
+        greatest name is kept. Unknown (zero) sizes extend to the next symbol.
+        """
+        order = sorted(range(len(addrs)), key=addrs.__getitem__)
+        self.sym_addrs = array('Q')
+        self.sym_sizes = array('Q')
+        self.sym_names: list[str] = []
+        sa = self.sym_addrs
+        ss = self.sym_sizes
+        sn = self.sym_names
+        for i in order:
+            addr = addrs[i]
+            if sa and sa[-1] == addr:
+                ss[-1] = max(ss[-1], sizes[i])
+                sn[-1] = max(sn[-1], names[i])
+                continue
+            if ss and ss[-1] == 0:
+                ss[-1] = addr - sa[-1]
+            sa.append(addr)
+            ss.append(sizes[i])
+            sn.append(names[i])
+        if ss[-1] == 0:
+            ss[-1] = self.LAST_SYMBOL_MAX_SIZE + 1
+
+    def _detect_offset(self, kallsyms: str, addrs: array, names: list[str]) -> int:
+        """Returns the KASLR offset of the kernel described by kallsyms, relative to our symbols.
+
+        Assumes no offset if it can't be detected.
+        """
+        for name in ('_text', '_stext'):
+            if name in names:
+                static_addr = addrs[names.index(name)]
+                break
+        else:
+            self._parent.debug('Cannot detect the kernel offset: no _text symbol')
+            return 0
+        suffix = f' {name}\n'.encode()
+        try:
+            with open(kallsyms, 'rb') as f:
+                for line in f:
+                    if line.endswith(suffix):
+                        runtime_addr = int(line.split(maxsplit=1)[0], 16)
+                        if runtime_addr == 0:  # restricted
+                            break
+                        return runtime_addr - static_addr
+        except (OSError, ValueError) as e:
+            self._parent.debug(f'Cannot detect the kernel offset from {kallsyms}: {e}')
+            return 0
+        self._parent.debug(f'Cannot detect the kernel offset: no {name} in {kallsyms}')
+        return 0
 
     def __call__(self, addrstr: str):
         if self.error:
             return addrstr + '\n'
 
         sa = self.sym_addrs
-        sn = self.sym_names
         slen = len(sa)
-        address = int(addrstr, 16)
+        address = int(addrstr, 16) - self.offset
         idx = bisect.bisect_right(sa, address) - 1
         assert -1 <= idx < slen
         if idx == -1:
             return f'{addrstr} ({sa[0] - address} bytes before first symbol)\n'
-        if idx == slen - 1:
-            # We can easily detect symbol addresses which are too small: they fall before
-            # the first symbol in kallsyms, but for too large it is harder: we can't really
-            # distinguish between an address that is in the *very last* function in the symbol map
-            # and one which is beyond that, since kallsyms doesn't include symbol size. Instead
-            # we use a bit of a quick and dirty heuristic: if the symbol is *far enough* beyond
-            # the last symbol we assume it is not valid. Most likely, the overwhelming majority
-            # of cases are invalid (e.g., due to KASLR) as the final symbol in the map is usually
-            # something obscure.
-            lastsym = sa[-1]
-            if address - lastsym > self.LAST_SYMBOL_MAX_SIZE:
-                return f'{addrstr} ({address - lastsym} bytes after last symbol)\n'
         saddr = sa[idx]
         assert saddr <= address
-        return f'{sn[idx]}+0x{address - saddr:x}\n'
+        if address - saddr >= self.sym_sizes[idx]:
+            # Beyond the end of the symbol. Unless we know the real symbol sizes
+            # (from a vmlinux), this can only be detected after the last symbol,
+            # for which we use a bit of a quick and dirty heuristic: if the address
+            # is *far enough* beyond it we assume it is not valid. Most likely, the
+            # overwhelming majority of cases are invalid (e.g., due to KASLR) as the
+            # final symbol in the map is usually something obscure.
+            if idx == slen - 1:
+                return f'{addrstr} ({address - saddr} bytes after last symbol)\n'
+            return f'{addrstr} ({address - saddr} bytes after {self.sym_names[idx]})\n'
+        return f'{self.sym_names[idx]}+0x{address - saddr:x}\n'
+
+    def resolve_many(self, addresses: Sequence[str]) -> list[str]:
+        return [self(address) for address in addresses]
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ElfResolver:
+    """An in-process resolver which reads the symbol table and DWARF info of a binary.
+
+    Symbols, line tables and inlined subroutines are loaded once into sorted
+    address arrays, and lookups are binary searches, as in KernelResolver.
+    The output mimics `llvm-addr2line -Cfpi`. Requires pyelftools.
+    """
+
+    def __init__(self, parent: 'BacktraceResolver', binary: str, concise: bool = False):
+        if ELFFile is None:
+            raise RuntimeError('the native resolver backend requires pyelftools')
+        self._parent = parent
+        self._binary = binary
+        self._concise = concise
+        self._demangled: dict[str, str] = {}
+
+        # .symtab functions, used when there is no debug info for an address
+        self._sym_addrs = array('Q')
+        self._sym_ends = array('Q')
+        self._sym_names: list[str] = []
+        # line table rows; a None file marks the end of a sequence
+        self._line_addrs = array('Q')
+        self._line_files: list[Optional[str]] = []
+        self._line_numbers = array('L')
+        self._line_discriminators = array('L')
+        # address ranges of the (non-inlined) subprograms
+        self._func_addrs = array('Q')
+        self._func_ends = array('Q')
+        self._func_ids = array('L')
+        # per function: its name, and its inlined subroutines in depth-first order,
+        # as (low, high, name, call_file, call_line) tuples
+        self._func_names: list[str] = []
+        self._func_inlines: list[list[tuple[int, int, str, str, int]]] = []
+
+        try:
+            f = open(binary, 'rb')
+        except OSError as e:
+            print(f'Cannot open {binary}: {e}')
+            self._missing = True
+            return
+        self._missing = False
+        load_start = parent.timing_now()
+        with f:
+            try:
+                elf = ELFFile(f)
+                self._load_symbols(elf)
+                if elf.has_dwarf_info():
+                    self._load_dwarf(elf.get_dwarf_info())
+                else:
+                    print(f'{binary}: no debug info')
+            except ELFError as e:
+                print(f'{binary}: {e}')
+        parent.timing_print_from_start(load_start, f'loading symbols of {binary}')
+
+    def _load_symbols(self, elf: Any):
+        section = elf.get_section_by_name('.symtab') or elf.get_section_by_name('.dynsym')
+        if section is None:
+            return
+        syms = sorted(
+            (sym['st_value'], sym['st_size'], sym.name)
+            for sym in section.iter_symbols()
+            if sym['st_info']['type'] == 'STT_FUNC' and sym['st_value']
+        )
+        for i, (addr, size, name) in enumerate(syms):
+            # like llvm-addr2line, let symbols without a size extend up to the next one
+            if not size:
+                size = syms[i + 1][0] - addr if i + 1 < len(syms) else 2**64 - 1 - addr
+            self._sym_addrs.append(addr)
+            self._sym_ends.append(addr + size)
+            self._sym_names.append(name)
+
+    @staticmethod
+    def _die_ranges(dwarf: Any, cu: Any, die: Any) -> list[tuple[int, int]]:
+        attrs = die.attributes
+        if 'DW_AT_low_pc' in attrs and 'DW_AT_high_pc' in attrs:
+            low = attrs['DW_AT_low_pc'].value
+            high = attrs['DW_AT_high_pc']
+            if high.form.startswith('DW_FORM_addr'):
+                return [(low, high.value)]
+            return [(low, low + high.value)]
+        if 'DW_AT_ranges' in attrs:
+            top = cu.get_top_DIE().attributes
+            base = top['DW_AT_low_pc'].value if 'DW_AT_low_pc' in top else 0
+            res: list[tuple[int, int]] = []
+            rangelists = dwarf.range_lists()
+            if rangelists is None:
+                return res
+            for entry in rangelists.get_range_list_at_offset(attrs['DW_AT_ranges'].value, cu=cu):
+                if hasattr(entry, 'base_address'):
+                    base = entry.base_address
+                elif entry.is_absolute:
+                    res.append((entry.begin_offset, entry.end_offset))
+                else:
+                    res.append((base + entry.begin_offset, base + entry.end_offset))
+            return res
+        return []
+
+    @staticmethod
+    def _die_name(die: Any) -> Optional[str]:
+        """Returns the (possibly mangled) name of a subprogram DIE."""
+        for _ in range(8):  # bound the abstract_origin/specification chain
+            attrs = die.attributes
+            for attr in ('DW_AT_linkage_name', 'DW_AT_MIPS_linkage_name', 'DW_AT_name'):
+                if attr in attrs:
+                    return attrs[attr].value.decode('utf-8', errors='replace')
+            for attr in ('DW_AT_abstract_origin', 'DW_AT_specification'):
+                if attr in attrs:
+                    die = die.get_DIE_from_attribute(attr)
+                    break
+            else:
+                return None
+        return None
+
+    def _load_dwarf(self, dwarf: Any):
+        lines: list[tuple[int, bool, Optional[str], int, int]] = []
+        funcs: list[tuple[int, int, int]] = []
+        for seq, cu in enumerate(dwarf.iter_CUs()):
+            top = cu.get_top_DIE()
+            comp_dir = top.attributes.get('DW_AT_comp_dir')
+            comp_dir = comp_dir.value.decode('utf-8', errors='replace') if comp_dir else ''
+            lineprog = dwarf.line_program_for_CU(cu)
+            if lineprog is None:
+                continue
+            version = lineprog.header['version']
+            dirs = [d.decode('utf-8', errors='replace') for d in lineprog['include_directory']]
+            files: list[str] = []
+            for entry in lineprog['file_entry']:
+                name = entry.name.decode('utf-8', errors='replace')
+                dir_index = entry.dir_index if version >= 5 else entry.dir_index - 1
+                directory = dirs[dir_index] if 0 <= dir_index < len(dirs) else comp_dir
+                files.append(os.path.join(comp_dir, directory, name))
+
+            def file_name(index: int) -> str:
+                index = index if version >= 5 else index - 1
+                return files[index] if 0 <= index < len(files) else '??'
+
+            for entry in lineprog.get_entries():
+                state = entry.state
+                if state is None:
+                    continue
+                if state.end_sequence:
+                    lines.append((state.address, False, None, 0, 0))
+                else:
+                    lines.append(
+                        (
+                            state.address,
+                            True,
+                            file_name(state.file),
+                            state.line,
+                            state.discriminator,
+                        )
+                    )
+
+            def walk(die: Any, func: int):
+                for child in die.iter_children():
+                    if child.tag == 'DW_TAG_inlined_subroutine' and func >= 0:
+                        name = self._die_name(child) or '??'
+                        call_file = (
+                            file_name(child.attributes['DW_AT_call_file'].value)
+                            if 'DW_AT_call_file' in child.attributes
+                            else '??'
+                        )
+                        call_line = (
+                            child.attributes['DW_AT_call_line'].value
+                            if 'DW_AT_call_line' in child.attributes
+                            else 0
+                        )
+                        for low, high in self._die_ranges(dwarf, cu, child):
+                            self._func_inlines[func].append((low, high, name, call_file, call_line))
+                        walk(child, func)
+                    elif child.tag == 'DW_TAG_subprogram':
+                        ranges = self._die_ranges(dwarf, cu, child)
+                        if ranges:
+                            fid = len(self._func_names)
+                            self._func_names.append(self._die_name(child) or '??')
+                            self._func_inlines.append([])
+                            funcs.extend((low, high, fid) for low, high in ranges)
+                            walk(child, fid)
+                        else:
+                            walk(child, func)
+                    elif child.has_children:
+                        walk(child, func)
+
+            walk(top, -1)
+
+        # the sort is stable, so rows for the same address keep their order, except that
+        # the end of a sequence goes before the rows of a sequence starting right there
+        lines.sort(key=lambda row: (row[0], row[1]))
+        for addr, _, file, line, discriminator in lines:
+            self._line_addrs.append(addr)
+            self._line_files.append(file)
+            self._line_numbers.append(line)
+            self._line_discriminators.append(discriminator)
+        funcs.sort()
+        for low, high, fid in funcs:
+            self._func_addrs.append(low)
+            self._func_ends.append(high)
+            self._func_ids.append(fid)
+
+    def _lookup(self, address: int) -> list[tuple[str, str, int, int]]:
+        """Returns the (name, file, line, discriminator) frames of an address, innermost first."""
+        file, line, discriminator = '??', 0, 0
+        idx = bisect.bisect_right(self._line_addrs, address) - 1
+        if idx >= 0 and self._line_files[idx] is not None:
+            file = notNone(self._line_files[idx])
+            line = self._line_numbers[idx]
+            discriminator = self._line_discriminators[idx]
+
+        symbol = None
+        idx = bisect.bisect_right(self._sym_addrs, address) - 1
+        if idx >= 0 and address < self._sym_ends[idx]:
+            symbol = self._sym_names[idx]
+
+        idx = bisect.bisect_right(self._func_addrs, address) - 1
+        if idx < 0 or address >= self._func_ends[idx]:
+            return [(symbol or '??', file, line, discriminator)]
+
+        fid = self._func_ids[idx]
+        # inlined subroutines are kept in depth-first order, so the ones
+        # containing the address come out from the outermost to the innermost
+        chain = [inline for inline in self._func_inlines[fid] if inline[0] <= address < inline[1]]
+        frames = []
+        for _, _, name, call_file, call_line in reversed(chain):
+            frames.append((name, file, line, discriminator))
+            file, line, discriminator = call_file, call_line, 0
+        # like llvm-addr2line, name the outermost frame after its symbol, which
+        # tells the parts of a split function apart, e.g. main.cold from main
+        frames.append((symbol or self._func_names[fid], file, line, discriminator))
+        return frames
+
+    def _demangle(self, names: Iterable[str]):
+        missing = [name for name in dict.fromkeys(names) if name not in self._demangled]
+        if not missing:
+            return
+        # c++filt prints the suffix of a clone, e.g. _Z1fv.cold, as
+        # "f() [clone .cold]", while llvm-addr2line prints "f() (.cold)"
+        # (concise names drop it either way)
+        mangled = [
+            name.partition('.') if name.startswith('_Z') and not self._concise else (name, '', '')
+            for name in missing
+        ]
+        args = ['c++filt', '-p'] if self._concise else ['c++filt']
+        output = subprocess.run(
+            args,
+            input='\n'.join(base for base, _, _ in mangled) + '\n',
+            stdout=subprocess.PIPE,
+            text=True,
+            check=True,
+        ).stdout
+        for name, (base, dot, suffix), demangled in zip(missing, mangled, output.splitlines()):
+            if dot and demangled != base:
+                demangled = f'{demangled} (.{suffix})'
+            elif dot:
+                demangled = name
+            self._demangled[name] = demangled
+
+    def resolve_many(self, addresses: Sequence[str]) -> list[str]:
+        if self._missing:
+            return [" ".join([self._binary, address, '\n']) for address in addresses]
+        lookups = [self._lookup(int(address, 16)) for address in addresses]
+        self._demangle(name for frames in lookups for name, _, _, _ in frames)
+        res = []
+        for frames in lookups:
+            out = [
+                f'{self._demangled.get(name, name)} at {file}:{line}'
+                + (f' (discriminator {discriminator})' if discriminator else '')
+                + '\n'
+                for name, file, line, discriminator in frames
+            ]
+            res.append(' (inlined by) '.join(out))
+        return res
+
+    def __call__(self, address: str):
+        return self.resolve_many([address])[0]
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
 
 
 LineResult = dict[
@@ -229,8 +1152,106 @@ LineResult = dict[
 ]
 
 
+def _text(line: Union[str, bytes]) -> str:
+    return line.decode(errors='replace') if isinstance(line, bytes) else line
+
+
+class ResolverStats:
+    """Counters and latencies of a BacktraceResolver, to tune large decode jobs.
+
+    Durations are only measured with timing enabled.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.backtraces = 0
+        self.duplicate_backtraces = 0
+        # addresses of the backtraces to resolve, those already resolved
+        # in this run, and those looked up in, and found in, the symbol cache
+        self.addresses = 0
+        self.memo_hits = 0
+        self.cache_lookups = 0
+        self.cache_hits = 0
+        self.phases: dict[str, float] = collections.defaultdict(float)
+        # per module, the (duration, number of addresses) of each resolver batch,
+        # not counting the setup of the module resolver, a phase of its own
+        self.batches: dict[str, list[tuple[float, int]]] = collections.defaultdict(list)
+
+    @staticmethod
+    def percentile(values: list[float], q: float) -> float:
+        """Returns the q-th (0 <= q <= 1) percentile of sorted values, by the nearest rank."""
+        return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+    def modules(self) -> dict[str, dict[str, Any]]:
+        res: dict[str, dict[str, Any]] = {}
+        for module, batches in self.batches.items():
+            # the percentiles are of the resolve time per address of the batches
+            per_address = sorted(duration / n for duration, n in batches if n)
+            res[module] = {
+                'batches': len(batches),
+                'addresses': sum(n for _, n in batches),
+                'total': sum(duration for duration, _ in batches),
+                'p50': self.percentile(per_address, 0.5),
+                'p99': self.percentile(per_address, 0.99),
+            }
+        return res
+
+
+Record = dict[str, Any]
+
+# a line of resolved address output, e.g.:
+#   seastar::reactor::run() at ./build/release/seastar/./seastar/src/core/reactor.cc:3308
+#    (inlined by) seastar::app_template::run() at ./seastar/src/core/app-template.cc:276
+# or, for unknown addresses, "?? at ??:0" (llvm-addr2line) or "?? ??:0" (addr2line)
+resolved_frame_re = re.compile(
+    r'^(?P<inlined> \(inlined by\) )?(?P<function>.*)(?: at |(?<! at) (?=\?\?:))'
+    r'(?P<file>.*):(?P<line>\d+|\?)(?: \(discriminator \d+\))?$'
+)
+
+
+def split_frame(frame: str) -> tuple[Optional[str], str]:
+    """Splits a "module+0xaddr" frame into its module, None if it has none, and address.
+
+    The split is on the last "+", as module names may contain one, e.g., libstdc++.so.6.
+    """
+    module, plus, address = frame.rpartition('+')
+    return (module, address) if plus else (None, address)
+
+
+def split_resolved_address(resolved: str) -> list[dict[str, Any]]:
+    """Splits the resolver output for an address into its (possibly inlined) frames.
+
+    Each frame is a dict with the function, file, line and inlined keys.
+    Unknown values are None, and output not in the addr2line format (e.g.,
+    kernel symbols) is returned whole as the function.
+    """
+    frames: list[dict[str, Any]] = []
+    for line in resolved.splitlines():
+        m = resolved_frame_re.match(line)
+        if not m:
+            frames.append({'function': line.strip(), 'file': None, 'line': None, 'inlined': False})
+            continue
+        function, file, lineno = m.group('function', 'file', 'line')
+        frames.append(
+            {
+                'function': None if function == '??' else function,
+                'file': None if file == '??' else file,
+                'line': int(lineno) if lineno.isdigit() and lineno != '0' else None,
+                'inlined': m.group('inlined') is not None,
+            }
+        )
+    return frames
+
+
 class BacktraceResolver:
 
+    class RecordType(Enum):
+        LINE = 1
+        BACKTRACE = 2
+
+    # minimum number of addresses of a module handed to a preresolve() worker
+    MIN_SHARD_SIZE = 64
+
     class BacktraceParser:
         class Type(Enum):
             ADDRESS = 1
@@ -241,113 +1262,110 @@ class BacktraceResolver:
             path = r"\S+"
             token = fr"(?:{path}\+)?{addr}"
             full_addr_match = fr"(?:(?P<path>{path})\s*\+\s*)?(?P<addr>{addr})"
-            ignore_addr_match = fr"(?:(?P<path>{path})\s*\+\s*)?(?:{addr})"
 
-            self.asan_ignore_re = re.compile(f"^=.*$", flags=re.IGNORECASE)
             self.separator_re = re.compile(r'^\W*-+\W*$')
-
-            # All of the below except for separator_re must only match lines containing 0x in them
-            # as we use that as a quick first filter
-            self.oneline_re = re.compile(
-                fr"^((?:.*(?:(?:at|backtrace):?|:))?(?:\s+))?({token}(?:\s+{token})*)(?:\).*|\s*)$",
-                flags=re.IGNORECASE,
-            )
+            # match counts of the line formats below, and of candidate lines matching none
+            self.hits: collections.Counter[str] = collections.Counter()
             self.address_re = re.compile(full_addr_match, flags=re.IGNORECASE)
-            self.syslog_re = re.compile(
-                fr"^(?:#\d+\s+)(?P<addr>{addr})(?:.*\s+)\({ignore_addr_match}\)\s*$",
-                flags=re.IGNORECASE,
-            )
-            self.kernel_re = re.compile(fr'^.*kernel callstack: (?P<addrs>(?:{addr}\s*)+)$')
-            self.asan_re = re.compile(
-                fr"^(?:.*\s+)\({full_addr_match}\)(\s+\(BuildId: [0-9a-fA-F]+\))?$",
-                flags=re.IGNORECASE,
-            )
-            self.generic_re = re.compile(fr"^(?:.*\s+){full_addr_match}\s*$", flags=re.IGNORECASE)
+
+            # Every line format below ends with an address, possibly followed by
+            # whitespace, or has one right before a closing parenthesis. Lines
+            # without one are rejected up front, which is much cheaper than
+            # failing to match all the formats
+            self.candidate_re = re.compile(fr"{addr}(?:\)|\s*$)", flags=re.IGNORECASE)
+
+            # The line formats, as named alternatives of a single regex, so that a
+            # line is classified with one match. Alternatives are tried in order,
+            # so order here is important: the kernel callstack format needs to come
+            # first since it is more specific and would otherwise be matched by the
+            # oneline format which comes next.
+            # All of them must only match lines containing 0x in them as we use that
+            # as a quick first filter
+            formats = [
+                ('kernel', fr'^.*kernel callstack: (?P<kernel_addrs>(?:{addr}\s*)+)$'),
+                (
+                    'oneline',
+                    fr"(?i:^(?P<oneline_prefix>(?:.*(?:(?:at|backtrace):?|:))?(?:\s+))?"
+                    fr"(?P<oneline_addrs>{token}(?:\s+{token})*)(?:\).*|\s*)$)",
+                ),
+                (
+                    'syslog',
+                    fr"(?i:^(?:#\d+\s+)(?P<syslog_addr>{addr})(?:.*\s+)"
+                    fr"\((?:(?P<syslog_path>{path})\s*\+\s*)?(?:{addr})\)\s*$)",
+                ),
+                ('asan_ignore', r"(?i:^=.*$)"),
+                (
+                    'asan',
+                    fr"(?i:^(?:.*\s+)\((?:(?P<asan_path>{path})\s*\+\s*)?(?P<asan_addr>{addr})\)"
+                    fr"(?:\s+\(BuildId: [0-9a-fA-F]+\))?$)",
+                ),
+                (
+                    'generic',
+                    fr"(?i:^(?:.*\s+)(?:(?P<generic_path>{path})\s*\+\s*)?"
+                    fr"(?P<generic_addr>{addr})\s*$)",
+                ),
+            ]
+            self.line_re = re.compile('|'.join(f'(?P<{name}>{regex})' for name, regex in formats))
 
         def split_addresses(self, addrstring: str, default_path: Optional[str] = None):
             addresses: list[dict[str, Any]] = []
+            match = self.address_re.match
             for obj in addrstring.split():
-                m = re.match(self.address_re, obj)
+                m = match(obj)
                 assert m, f'addr did not match address regex: {obj}'
                 # print(f"  >>> '{obj}': address {m.groups()}")
-                addresses.append({'path': m.group(1) or default_path, 'addr': m.group(2)})
+                path, addr = m.groups()
+                addresses.append({'path': path or default_path, 'addr': addr})
             return addresses
 
         def __call__(self, line: str) -> dict[str, Any] | None:
 
             # quick up front check to eliminate a line from contention, which is at least
             # 30x faster than just diving into the regex matching (for one test file)
-            if not ("0x" in line or "0X" in line or self.separator_re.match(line)):
+            if not ("0x" in line or "0X" in line) or not self.candidate_re.search(line):
+                if self.separator_re.match(line):
+                    return {'type': self.Type.SEPARATOR}
                 # no addresses in this line, so it is not a backtrace line
                 return None
 
-            def get_prefix(s: Optional[str]):
-                if s is not None:
-                    s = s.strip()
-                return s or None
-
-            ret: LineResult
+            m = self.line_re.match(line)
+            if not m:
+                # print(f">>> '{line}': None")
+                self.hits['no match'] += 1
+                return None
 
-            # order here is important: the kernel callstack regex
-            # needs to come first since it is more specific and would
-            # otherwise be matched by the online regex which comes next
-            m = self.kernel_re.match(line)
-            if m:
+            fmt = notNone(m.lastgroup)
+            self.hits[fmt] += 1
+            # print(f">>> '{line}': {fmt} {m.groups()}")
+            if fmt == 'kernel':
                 return {
                     'type': self.Type.ADDRESS,
                     'prefix': 'kernel callstack: ',
-                    'addresses': self.split_addresses(m.group('addrs'), KERNEL_MODULE),
+                    'addresses': self.split_addresses(m.group('kernel_addrs'), KERNEL_MODULE),
                 }
 
-            m = re.match(self.oneline_re, line)
-            if m:
-                # print(f">>> '{line}': oneline {m.groups()}")
+            if fmt == 'oneline':
+                prefix = m.group('oneline_prefix')
                 return {
                     'type': self.Type.ADDRESS,
-                    'prefix': get_prefix(m.group(1)),
-                    'addresses': self.split_addresses(m.group(2)),
+                    'prefix': prefix.strip() or None if prefix is not None else None,
+                    'addresses': self.split_addresses(m.group('oneline_addrs')),
                 }
 
-            m = re.match(self.syslog_re, line)
-            if m:
-                # print(f">>> '{line}': syslog {m.groups()}")
-                ret = {'type': self.Type.ADDRESS}
-                ret['prefix'] = None
-                ret['addresses'] = [{'path': m.group('path'), 'addr': m.group('addr')}]
-                return ret
-
-            m = re.match(self.asan_ignore_re, line)
-            if m:
-                # print(f">>> '{line}': asan ignore")
+            if fmt == 'asan_ignore':
                 return None
 
-            m = re.match(self.asan_re, line)
-            if m:
-                # print(f">>> '{line}': asan {m.groups()}")
-                ret = {'type': self.Type.ADDRESS}
-                ret['prefix'] = None
-                ret['addresses'] = [{'path': m.group('path'), 'addr': m.group('addr')}]
-                return ret
-
-            m = re.match(self.generic_re, line)
-            if m:
-                # print(f">>> '{line}': generic {m.groups()}")
-                ret = {'type': self.Type.ADDRESS}
-                ret['prefix'] = None
-                ret['addresses'] = [{'path': m.group('path'), 'addr': m.group('addr')}]
-                return ret
-
-            match = re.match(self.separator_re, line)
-            if match:
-                return {'type': self.Type.SEPARATOR}
-
-            # print(f">>> '{line}': None")
-            return None
+            # the syslog, asan and generic formats carry a single address
+            return {
+                'type': self.Type.ADDRESS,
+                'prefix': None,
+                'addresses': [{'path': m.group(f'{fmt}_path'), 'addr': m.group(f'{fmt}_addr')}],
+            }
 
     def __init__(
         self,
         executable: str,
-        kallsyms: str = '/proc/kallsyms',
+        kallsyms: Optional[str] = None,
         before_lines: int = 1,
         context_re: Optional[str] = '',
         verbose: bool = False,
@@ -355,18 +1373,83 @@ class BacktraceResolver:
         cmd_path: str = 'addr2line',
         debug: bool = False,
         timing: bool = False,
+        symbol_cache: Optional[str] = None,
+        backend: str = 'addr2line',
+        max_resolvers: int = 0,
+        vmlinux: Optional[str] = None,
+        kernel_offset: Optional[int] = None,
+        server: Optional[str] = None,
+        select_re: str = DEFAULT_SELECT_RE,
+        dedup_limit: int = 0,
+        output: Optional[BinaryIO] = None,
     ):
+        # the arguments needed to replicate this resolver in a worker process
+        self._config = dict(
+            executable=executable,
+            kallsyms=kallsyms,
+            verbose=verbose,
+            concise=concise,
+            cmd_path=cmd_path,
+            debug=debug,
+            timing=timing,
+            symbol_cache=symbol_cache,
+            backend=backend,
+            max_resolvers=max_resolvers,
+            vmlinux=vmlinux,
+            kernel_offset=kernel_offset,
+            server=server,
+            select_re=select_re,
+            dedup_limit=dedup_limit,
+        )
         self._debug = debug
         self._timing = timing
+        # where print_record() writes, sys.stdout if None
+        self._output = output
         self._total_resolve_time = 0.0
+        self.stats = ResolverStats()
+        # with an index of executables, lines matching select_re select the
+        # executable of the frames without a path in the backtraces which follow
+        self._executables: Optional[dict[str, str]] = None
+        self._select_re = None
+        self._unknown_keys: set[str] = set()
+        if is_executable_index(executable):
+            self._executables = load_executable_index(executable)
+            binaries = set(self._executables.values())
+            if 'default' in self._executables:
+                executable = self._executables['default']
+            elif len(binaries) == 1:
+                executable = binaries.pop()
+            else:
+                executable = UNKNOWN_EXECUTABLE
+            self._select_re = re.compile(select_re)
+            self.debug(f'Loaded {len(self._executables)} executables from the index')
+        self._default_executable = executable
         self._executable = executable
         self._kallsyms = kallsyms
+        self._vmlinux = vmlinux
+        self._kernel_offset = kernel_offset
         self._current_backtrace: list[tuple[str, str]] = []
-        self._prefix = None
+        self._current_lines: list[str] = []
+        self._prefix: Optional[str] = None
         self._before_lines = before_lines
-        self._before_lines_queue: collections.deque[str] = collections.deque(maxlen=before_lines)
+        # bytes when processing byte lines, see process_byte_lines()
+        self._before_lines_queue: collections.deque[Union[str, bytes]] = collections.deque(
+            maxlen=before_lines
+        )
         self._i = 0
-        self._known_backtraces: dict[str, int] = {}
+        # Modules are interned to small ints, and frames are keyed by an int
+        # combining the module id and the address value, see _frame_key().
+        # Backtraces are keyed by the array('Q') bytes of their module ids and
+        # addresses. So memory grows with the unique frames and backtraces,
+        # rather than with the input.
+        self._module_ids: dict[str, int] = {}
+        # backtrace numbers, least recently seen first, keyed by backtrace
+        self._known_backtraces: collections.OrderedDict[bytes, int] = collections.OrderedDict()
+        self._dedup_limit = dedup_limit
+        # resolved (non-verbose) output keyed by frame
+        self._resolved: dict[int, str] = {}
+        # the addresses to resolve, per module, while collecting them in preresolve()
+        self._collecting: Optional[dict[str, dict[str, None]]] = None
         if context_re is not None:
             self._context_re = re.compile(context_re)
         else:
@@ -374,10 +1457,27 @@ class BacktraceResolver:
         self._verbose = verbose
         self._concise = concise
         self._cmd_path = cmd_path
-        self._known_modules: dict[str, Union[Addr2Line, KernelResolver]] = {}
-        self._get_resolver_for_module(
-            self._executable
-        )  # fail fast if there is something wrong with the exe resolver
+        self._backend = backend
+        # module resolvers, least recently used first, along with the time of their last use
+        self._known_modules: collections.OrderedDict[
+            str, tuple[Union[Addr2Line, KernelResolver, ElfResolver], float]
+        ] = collections.OrderedDict()
+        self._max_resolvers = max_resolvers
+        self._build_ids: dict[str, Optional[str]] = {}
+        self._symbol_cache = None
+        if symbol_cache is not None:
+            tool = os.path.basename(cmd_path) if backend == 'addr2line' else backend
+            variant = f"{tool}{' concise' if concise else ''}"
+            self._symbol_cache = SymbolCache(symbol_cache, variant)
+        self._server: Optional[ResolverClient] = None
+        if server is not None:
+            options = {option: self._config[option] for option in ResolverServer.OPTIONS}
+            self._server = ResolverClient(server, options)
+        # resolvers are started lazily, but fail fast if they can't be started at all
+        elif backend == 'native' and ELFFile is None:
+            raise RuntimeError('the native resolver backend requires pyelftools')
+        elif backend == 'addr2line' and shutil.which(cmd_path) is None:
+            raise FileNotFoundError(f'addr2line command not found: {cmd_path}')
         self.parser = self.BacktraceParser()
 
     def debug(self, *args: Any):
@@ -397,107 +1497,498 @@ class BacktraceResolver:
     def print_resolve_time(self):
         self.timing_print(self._total_resolve_time, 'resolve time (addr2line subprocess time)')
 
+    def get_stats(self) -> dict[str, Any]:
+        """Returns the counters and latencies of this resolver, see ResolverStats."""
+        stats = self.stats
+        return {
+            'lines': stats.lines,
+            'parser_hits': dict(self.parser.hits),
+            'backtraces': stats.backtraces,
+            'duplicate_backtraces': stats.duplicate_backtraces,
+            'addresses': stats.addresses,
+            'unique_addresses': len(self._resolved),
+            'memo_hits': stats.memo_hits,
+            'cache_lookups': stats.cache_lookups,
+            'cache_hits': stats.cache_hits,
+            'phases': dict(stats.phases),
+            'resolve_time': self._total_resolve_time,
+            'modules': stats.modules(),
+        }
+
+    def print_stats(self, file: TextIO = sys.stderr):
+        """Prints the counters and latencies of this resolver as a summary table."""
+
+        def ratio(part: int, total: int):
+            return f'{part}/{total} ({100 * part / total if total else 0:.1f}%)'
+
+        stats = self.get_stats()
+        hits = ', '.join(f'{fmt} {n}' for fmt, n in sorted(stats['parser_hits'].items()))
+        phases = ', '.join(f'{phase} {t:.4f}s' for phase, t in stats['phases'].items())
+        print(f"STATS >> lines parsed: {stats['lines']}", file=file)
+        print(f"STATS >> parser hits: {hits or '-'}", file=file)
+        print(
+            f"STATS >> backtraces: {stats['backtraces']},"
+            f" duplicates: {ratio(stats['duplicate_backtraces'], stats['backtraces'])}",
+            file=file,
+        )
+        print(
+            f"STATS >> addresses: {stats['addresses']}, unique: {stats['unique_addresses']},"
+            f" already resolved: {ratio(stats['memo_hits'], stats['addresses'])}",
+            file=file,
+        )
+        # the symbol cache is gone once closed, but not its counters
+        if stats['cache_lookups']:
+            print(
+                f"STATS >> symbol cache hits: {ratio(stats['cache_hits'], stats['cache_lookups'])}",
+                file=file,
+            )
+        print(f"STATS >> phases: {phases or '-'}", file=file)
+        if stats['modules']:
+            width = max(len(module) for module in stats['modules'])
+            print(
+                f"STATS >> {'module':<{width}} {'batches':>8} {'addresses':>10}"
+                f" {'total s':>9} {'p50 ms/addr':>12} {'p99 ms/addr':>12}",
+                file=file,
+            )
+            for module, m in sorted(stats['modules'].items(), key=lambda i: -i[1]['total']):
+                print(
+                    f"STATS >> {module:<{width}} {m['batches']:>8} {m['addresses']:>10}"
+                    f" {m['total']:>9.4f} {m['p50'] * 1000:>12.4f} {m['p99'] * 1000:>12.4f}",
+                    file=file,
+                )
+
     def _get_resolver_for_module(self, module: str):
-        if not module in self._known_modules:
+        if module in self._known_modules:
+            resolver = self._known_modules.pop(module)[0]
+        else:
+            if self._max_resolvers > 0:
+                while len(self._known_modules) >= self._max_resolvers:
+                    evicted, (evicted_resolver, _) = self._known_modules.popitem(last=False)
+                    self.debug(f'Evicting resolver for module: {evicted}')
+                    evicted_resolver.close()
+            setup_start = self.timing_now()
             if module == KERNEL_MODULE:
-                resolver = KernelResolver(self, kallsyms=self._kallsyms)
+                resolver = KernelResolver(
+                    self, kallsyms=self._kallsyms, vmlinux=self._vmlinux, offset=self._kernel_offset
+                )
+            elif self._backend == 'native':
+                resolver = ElfResolver(self, module, self._concise)
             else:
                 resolver = Addr2Line(self, module, self._concise, self._cmd_path)
+            self.stats.phases['resolver setup'] += self.timing_now() - setup_start
             self.debug(f'Adding resolver {resolver} for module: {module}')
-            self._known_modules[module] = resolver
-        return self._known_modules[module]
+        self._known_modules[module] = (resolver, time.monotonic())
+        return resolver
+
+    def close_idle_resolvers(self, max_idle: float):
+        """Closes the module resolvers which were not used in the last max_idle seconds."""
+        now = time.monotonic()
+        while self._known_modules:
+            module, (resolver, last_use) = next(iter(self._known_modules.items()))
+            if now - last_use < max_idle:
+                break
+            self.debug(f'Closing idle resolver for module: {module}')
+            del self._known_modules[module]
+            resolver.close()
+
+    def close(self):
+        """Closes all the module resolvers, the symbol cache, and the server connection."""
+        while self._known_modules:
+            self._known_modules.popitem(last=False)[1][0].close()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if self._symbol_cache is not None:
+            self._symbol_cache.close()
+            self._symbol_cache = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, *_):
         self._print_current_backtrace()
+        self.close()
+
+    def _get_build_id(self, module: str) -> Optional[str]:
+        if module not in self._build_ids:
+            if module == KERNEL_MODULE:
+                self._build_ids[module] = None
+            else:
+                self._build_ids[module] = elf_build_id(module)
+            self.debug(f'Build-ID of {module}: {self._build_ids[module]}')
+        return self._build_ids[module]
+
+    def _lookup_symbol_cache(self, module: str, addresses: list[str]) -> dict[str, str]:
+        """Returns the resolutions of addresses of a module found in the symbol cache, if any."""
+        if self._symbol_cache is None:
+            return {}
+        build_id = self._get_build_id(module)
+        if build_id is None:
+            return {}
+        res = self._symbol_cache.lookup(build_id, addresses)
+        self.stats.cache_lookups += len(addresses)
+        self.stats.cache_hits += len(res)
+        self.debug(f'Symbol cache hits for {module}: {len(res)}/{len(addresses)}')
+        return res
+
+    def _store_symbol_cache(self, module: str, resolved: dict[str, str]):
+        if self._symbol_cache is None or not resolved:
+            return
+        build_id = self._get_build_id(module)
+        if build_id is not None:
+            self._symbol_cache.store(build_id, resolved)
+
+    def _resolve_module_addresses(self, module: str, addresses: list[str]) -> dict[str, str]:
+        """Resolves addresses of a module, through the symbol cache if one is used."""
+        res = self._lookup_symbol_cache(module, addresses)
+        addresses = [address for address in addresses if address not in res]
+        if addresses:
+            if self._server is None:
+                # set up the module resolver before timing the batch, its setup
+                # is timed as a phase of its own
+                resolver = self._get_resolver_for_module(module)
+                resolver.start()
+            resolve_start = self.timing_now()
+            if self._server is not None:
+                frames = [(module, address) for address in addresses]
+                resolved = dict(zip(addresses, self._server.resolve(frames)))
+            else:
+                resolved = dict(zip(addresses, resolver.resolve_many(addresses)))
+            duration = self.timing_now() - resolve_start
+            self._total_resolve_time += duration
+            self.stats.batches[module].append((duration, len(addresses)))
+            self._store_symbol_cache(module, resolved)
+            res.update(resolved)
+        return res
+
+    def _collect_addresses(
+        self, lines: Union[Iterable[str], Iterable[bytes]], binary: bool = False
+    ) -> dict[str, dict[str, None]]:
+        """Returns the unique uncached addresses of the backtraces in lines, per module.
+
+        The lines go through the same processing as when printing, minus the
+        output, so only backtraces which would be resolved (i.e., matching
+        the context regex, and not seen before) are considered. Must be called
+        before feeding any line to the resolver. Lines are bytes if binary is
+        True, see process_byte_lines().
+        """
+        self._collecting = collections.defaultdict(dict)
+        try:
+            if binary:
+                records = self.process_byte_lines(cast(Iterable[bytes], lines))
+            else:
+                records = self.process_lines(cast(Iterable[str], lines))
+            for _ in records:
+                pass
+            return self._collecting
+        finally:
+            self._collecting = None
+            self._current_backtrace = []
+            self._current_lines = []
+            self._prefix = None
+            self._before_lines_queue.clear()
+            self._i = 0
+            self._known_backtraces.clear()
+            self._executable = self._default_executable
+            # only count the lines when they are processed for real
+            self.parser.hits.clear()
+            self.stats.lines = 0
+            self.stats.backtraces = 0
+            self.stats.duplicate_backtraces = 0
+            self.stats.phases.pop('parse', None)
+
+    def preresolve(
+        self, lines: Union[Iterable[str], Iterable[bytes]], jobs: int = 1, binary: bool = False
+    ):
+        """Resolves all the addresses referenced by the backtraces in lines up front.
+
+        The unique addresses are collected in a first pass over lines and
+        resolved in bulk, sharded across `jobs` worker processes, each running
+        its own module resolvers, if jobs > 1. Processing the lines afterwards
+        is then served from the cache. Lines should be passed in the same form
+        as they are later fed to the resolver, as bytes if binary is True.
+        """
+        scan_start = self.timing_now()
+        missing = self._collect_addresses(lines, binary)
+        self.stats.phases['pre-scan'] += self.timing_now() - scan_start
+        self.timing_print_from_start(scan_start, 'pre-scan')
+        self.debug(
+            f'Pre-resolving {sum(len(a) for a in missing.values())} addresses'
+            f' of {len(missing)} modules with {jobs} jobs'
+        )
+        resolve_start = self.timing_now()
+        if jobs <= 1:
+            for module, addresses in missing.items():
+                self._remember(module, self._resolve_module_addresses(module, list(addresses)))
+        else:
+            self._preresolve_parallel(missing, jobs)
+        self.stats.phases['pre-resolve'] += self.timing_now() - resolve_start
+        self.timing_print_from_start(resolve_start, 'pre-resolve')
+
+    def _preresolve_parallel(self, missing: dict[str, dict[str, None]], jobs: int):
+        config = dict(self._config, symbol_cache=None, verbose=False, timing=False)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_preresolve_worker_init, initargs=(config,)
+        ) as pool:
+            futures: list[tuple[str, concurrent.futures.Future[tuple[dict[str, str], float]]]] = []
+            for module, module_addresses in missing.items():
+                addresses = list(module_addresses)
+                cached = self._lookup_symbol_cache(module, addresses)
+                self._remember(module, cached)
+                addresses = [address for address in addresses if address not in cached]
+                if not addresses:
+                    continue
+                if module == KERNEL_MODULE:
+                    # kallsyms is loaded by this process anyway and lookups are cheap
+                    self._remember(module, self._resolve_module_addresses(module, addresses))
+                    continue
+                # shard the addresses of the module across the workers, but don't
+                # bother with tiny shards, they cost more than they save
+                shard_size = max(-(-len(addresses) // jobs), self.MIN_SHARD_SIZE)
+                for i in range(0, len(addresses), shard_size):
+                    shard = addresses[i : i + shard_size]
+                    futures.append((module, pool.submit(_preresolve_worker, module, shard)))
+            for module, future in futures:
+                resolved, duration = future.result()
+                self._total_resolve_time += duration
+                self.stats.batches[module].append((duration, len(resolved)))
+                self._store_symbol_cache(module, resolved)
+                self._remember(module, resolved)
+
+    def _module_id(self, module: str) -> int:
+        module_id = self._module_ids.get(module)
+        if module_id is None:
+            module_id = self._module_ids[module] = len(self._module_ids)
+        return module_id
+
+    def _frame_key(self, module: str, address: str) -> int:
+        """Returns the key of a frame: its module id in the high bits, and its address."""
+        return self._module_id(module) << 64 | int(address, 16)
+
+    def _backtrace_key(self, frames: list[tuple[str, str]]) -> bytes:
+        key = array('Q')
+        for module, address in frames:
+            key.append(self._module_id(module))
+            key.append(int(address, 16))
+        return key.tobytes()
+
+    def _remember(self, module: str, resolved: dict[str, str]):
+        """Adds the resolved addresses of a module to the resolved frames."""
+        for address, resolved_address in resolved.items():
+            self._resolved[self._frame_key(module, address)] = resolved_address
 
-    @cache
     def resolve_address(
         self, address: str, module: Optional[str] = None, verbose: Optional[bool] = None
     ):
-        if module is None:
-            module = self._executable
+        return self.resolve_addresses([(module, address)], verbose)[0]
+
+    def resolve_addresses(
+        self, frames: Iterable[tuple[Optional[str], str]], verbose: Optional[bool] = None
+    ) -> list[str]:
+        """Resolves (module, address) pairs, a None module standing for the executable.
+
+        Addresses missing from the cache are grouped per module and sent to
+        the module resolver in a single batch.
+        """
         if verbose is None:
             verbose = self._verbose
-        resolver = self._get_resolver_for_module(module)
-        resolve_start = self.timing_now()
-        resolved_address = resolver(address)
-        self._total_resolve_time += self.timing_now() - resolve_start
+        module_frames = [(module or self._executable, address) for module, address in frames]
+        keys = [self._frame_key(module, address) for module, address in module_frames]
+        missing: dict[str, dict[str, None]] = collections.defaultdict(dict)
+        for (module, address), key in zip(module_frames, keys):
+            if key not in self._resolved:
+                missing[module][address] = None
+            else:
+                self.stats.memo_hits += 1
+        self.stats.addresses += len(module_frames)
+        for module, addresses in missing.items():
+            self._remember(module, self._resolve_module_addresses(module, list(addresses)))
+        res = [self._resolved[key] for key in keys]
         if verbose:
-            resolved_address = '{{{}}} {}: {}'.format(module, address, resolved_address)
-        return resolved_address
-
-    def _print_resolved_address(self, module: Optional[str], address: str):
-        sys.stdout.write(self.resolve_address(address, module))
+            res = [
+                '{{{}}} {}: {}'.format(module, address, resolved_address)
+                for (module, address), resolved_address in zip(module_frames, res)
+            ]
+        return res
 
-    def _backtrace_context_matches(self):
+    def _backtrace_context_matches(self, prefix: Optional[str]):
         if self._context_re is None:
             return True
 
-        if any(self._context_re.search(x) for x in self._before_lines_queue):
+        if any(self._context_re.search(_text(x)) for x in self._before_lines_queue):
             return True
 
-        if (not self._prefix is None) and self._context_re.search(self._prefix):
+        if (not prefix is None) and self._context_re.search(prefix):
             return True
 
         return False
 
-    def _print_current_backtrace(self):
+    def _flush_current_backtrace(self, resolve: bool = True) -> Optional[Record]:
+        """Ends the current backtrace and returns its record, if it is to be reported.
+
+        The record is only resolved if resolve is True, otherwise its
+        'resolved' entry is left None for the caller to fill in.
+        """
         if len(self._current_backtrace) == 0:
-            return
+            return None
 
-        if not self._backtrace_context_matches():
-            self._current_backtrace = []
+        frames = self._current_backtrace
+        lines = self._current_lines
+        prefix = self._prefix
+        self._current_backtrace = []
+        self._current_lines = []
+        self._prefix = None
+
+        if not self._backtrace_context_matches(prefix):
+            return None
+
+        record: Record = {
+            'type': self.RecordType.BACKTRACE,
+            'index': self._i,
+            'duplicate': False,
+            'context': list(self._before_lines_queue),
+            'prefix': prefix,
+            'lines': lines,
+            'frames': frames,
+            'resolved': None,
+        }
+
+        self.stats.backtraces += 1
+        backtrace = self._backtrace_key(frames)
+        index = self._known_backtraces.get(backtrace)
+        if index is not None:
+            self._known_backtraces.move_to_end(backtrace)
+            record['index'] = index
+            record['duplicate'] = True
+            self.stats.duplicate_backtraces += 1
+            return record
+
+        self._known_backtraces[backtrace] = self._i
+        if 0 < self._dedup_limit < len(self._known_backtraces):
+            # forget the least recently seen backtrace, it will get a new
+            # number if seen again
+            self._known_backtraces.popitem(last=False)
+        self._i += 1
+
+        if self._collecting is not None:
+            for module, addr in frames:
+                if self._frame_key(module, addr) not in self._resolved:
+                    self._collecting[module][addr] = None
+        elif resolve:
+            self.debug(f'Resolving parsed backtrace with {len(frames)} frames')
+            record['resolved'] = self.resolve_addresses(frames)
+        return record
+
+    def record_to_json(self, record: Record) -> dict[str, Any]:
+        """Converts a BACKTRACE record to a JSON serializable dict.
+
+        Resolved frames are split into their function, file, line, and
+        inlined flag. Duplicate backtraces are resolved too (from the cache).
+        """
+        frames = record['frames']
+        resolved = record['resolved']
+        if resolved is None:
+            resolved = self.resolve_addresses(frames, verbose=False)
+        return {
+            'index': record['index'],
+            'duplicate': record['duplicate'],
+            'prefix': record['prefix'],
+            'context': [_text(line).rstrip('\n') for line in record['context']],
+            'lines': [line.rstrip('\n') for line in record['lines']],
+            'frames': [
+                {'module': module, 'address': address, 'resolved': split_resolved_address(res)}
+                for (module, address), res in zip(frames, resolved)
+            ],
+        }
+
+    def _write(self, data: Union[str, bytes]):
+        """Writes to the output, bytes lines from process_byte_lines() included."""
+        if self._output is not None:
+            self._output.write(data.encode() if isinstance(data, str) else data)
+        else:
+            sys.stdout.write(data.decode(errors='replace') if isinstance(data, bytes) else data)
+
+    def print_record(self, record: Record):
+        write = self._write
+        if record['type'] == self.RecordType.LINE:
+            write(record['line'])  # line already has a trailing newline
             return
 
-        for line in self._before_lines_queue:
-            sys.stdout.write(line)
+        for line in record['context']:
+            write(line)
 
-        if not self._prefix is None:
-            print(self._prefix)
-            self._prefix = None
+        if not record['prefix'] is None:
+            write(record['prefix'] + '\n')
 
-        backtrace = "".join(map(str, self._current_backtrace))
-        if backtrace in self._known_backtraces:
-            print(
-                "[Backtrace #{}] Already seen, not resolving again.".format(
-                    self._known_backtraces[backtrace]
-                )
-            )
-            print("")  # To separate traces with an empty line
-            self._current_backtrace = []
+        if record['duplicate']:
+            write("[Backtrace #{}] Already seen, not resolving again.\n".format(record['index']))
+            write("\n")  # To separate traces with an empty line
             return
 
-        self._known_backtraces[backtrace] = self._i
+        write("[Backtrace #{}]\n".format(record['index']))
 
-        self.debug(
-            f'Resolving and printing parsed backtrace with {len(self._current_backtrace)} frames'
-        )
+        for resolved_address in record['resolved']:
+            write(resolved_address)
 
-        print("[Backtrace #{}]".format(self._i))
+        write("\n")  # To separate traces with an empty line
 
-        for module, addr in self._current_backtrace:
-            self._print_resolved_address(module, addr)
+    def _print_current_backtrace(self):
+        record = self._flush_current_backtrace()
+        if record is not None:
+            self.print_record(record)
 
-        print("")  # To separate traces with an empty line
+    build_id_re = re.compile(r'\(BuildId: ([0-9a-fA-F]+)\)')
 
-        self._current_backtrace = []
-        self._i += 1
+    def _select_executable(self, line: str):
+        m = notNone(self._select_re).search(line)
+        if not m:
+            return
+        key = m.group('key')
+        executables = notNone(self._executables)
+        executable = executables.get(key) or executables.get(key.lower())
+        if executable is None:
+            if key not in self._unknown_keys:
+                self._unknown_keys.add(key)
+                print(f'WARNING: no executable for {key} in the index', file=sys.stderr)
+            return
+        if executable != self._executable:
+            self.debug(f'Selected executable {executable} for {key}')
+            self._executable = executable
+
+    def _process_unmatched(self, line: Union[str, bytes], resolve: bool) -> list[Record]:
+        """Processes a line which is not part of a backtrace."""
+        records: list[Record] = []
+        record = self._flush_current_backtrace(resolve)
+        if record is not None:
+            records.append(record)
+        if self._before_lines > 0:
+            self._before_lines_queue.append(line)
+        elif self._before_lines < 0:
+            records.append({'type': self.RecordType.LINE, 'line': line})
+        else:
+            pass  # when == 0 no non-backtrace lines are printed
+        return records
 
-    def __call__(self, line: str):
-        res = self.parser(line)
+    def _process(self, line: str, resolve: bool = True) -> list[Record]:
+        self.stats.lines += 1
+        if self._timing:
+            parse_start = time.perf_counter()
+            res = self.parser(line)
+            self.stats.phases['parse'] += time.perf_counter() - parse_start
+        else:
+            res = self.parser(line)
+        records: list[Record] = []
+
+        def flush():
+            record = self._flush_current_backtrace(resolve)
+            if record is not None:
+                records.append(record)
 
         if not res:
             self.debug('INPUT LINE [NO MATCH]:', line)
-            self._print_current_backtrace()
-            if self._before_lines > 0:
-                self._before_lines_queue.append(line)
-            elif self._before_lines < 0:
-                sys.stdout.write(line)  # line already has a trailing newline
-            else:
-                pass  # when == 0 no non-backtrace lines are printed
+            if self._select_re is not None:
+                self._select_executable(line)
+            return self._process_unmatched(line, resolve)
         elif res['type'] == self.BacktraceParser.Type.SEPARATOR:
             self.debug('INPUT LINE [SEPARATOR]:', line)
             pass
@@ -505,17 +1996,378 @@ class BacktraceResolver:
             self.debug('INPUT LINE [ADDRESS]:', line)
             addresses = cast(list[dict[str, Any]], res['addresses'])
             if len(addresses) > 1:
-                self._print_current_backtrace()
+                flush()
             if len(self._current_backtrace) == 0:
                 self._prefix = cast(Union[str, None], res['prefix'])
+            indexed_module = None
+            if self._executables is not None and 'BuildId' in line:
+                # asan frames carry the Build-ID of their binary, which may be
+                # indexed under a path other than the one they were run from
+                m = self.build_id_re.search(line)
+                if m:
+                    indexed_module = self._executables.get(m.group(1).lower())
             for r in addresses:
-                if r['path']:
+                if indexed_module is not None:
+                    self._current_backtrace.append((indexed_module, r['addr']))
+                elif r['path']:
                     self._current_backtrace.append((r['path'], r['addr']))
                 else:
                     self._current_backtrace.append((self._executable, r['addr']))
+            self._current_lines.append(line)
             if len(addresses) > 1:
-                self._print_current_backtrace()
+                flush()
         else:
             self.debug('INPUT LINE [UNKNOWN]:', line)
             print(f"Unknown '{line}': {res}")
             raise RuntimeError("Unknown result type {res}")
+        return records
+
+    def process(self, line: str) -> list[Record]:
+        """Feeds a line to the resolver and returns the records it completes.
+
+        A record is a dict whose 'type' is a RecordType. LINE records carry a
+        non-backtrace 'line' to pass through (only with before_lines < 0).
+        BACKTRACE records carry:
+          index      - the backtrace number, shared by identical backtraces
+          duplicate  - whether an identical backtrace was reported already
+          context    - the non-backtrace lines preceding the backtrace
+          prefix     - the text preceding the addresses on the first line, if any
+          lines      - the input lines the backtrace was parsed from
+          frames     - the (module, address) pairs of the backtrace
+          resolved   - the resolved frames, None for duplicates
+        A backtrace is only complete once a line not belonging to it is seen,
+        see flush().
+        """
+        return self._process(line)
+
+    def flush(self) -> Optional[Record]:
+        """Completes the pending backtrace, if any, and returns its record."""
+        return self._flush_current_backtrace()
+
+    def process_lines(self, lines: Iterable[str]) -> Iterator[Record]:
+        """Yields the records of lines, see process(), flushing the last backtrace at the end."""
+        for line in lines:
+            yield from self._process(line)
+        record = self._flush_current_backtrace()
+        if record is not None:
+            yield record
+
+    def process_byte_lines(self, lines: Iterable[bytes]) -> Iterator[Record]:
+        """The flavour of process_lines() for undecoded lines, e.g., from read_byte_lines().
+
+        Only the lines which may belong to a backtrace, i.e., which contain 0x
+        or may be separators, are decoded (invalid UTF-8 being replaced). Other
+        lines are kept as bytes in the records, as context or LINE records, or
+        not kept at all with before_lines == 0, unless they need to be matched
+        against the context or executable selection regexes. Use an output
+        stream with print_record() to write them out undecoded.
+        """
+        decode_all = self._context_re is not None or self._select_re is not None
+        # (searching for 0x with a regex is faster than with `in`)
+        has_0x = re.compile(rb'0[xX]').search
+        # a superset of the separator lines, as \W matches any non-ASCII byte
+        maybe_separator = re.compile(rb'^\W*-+\W*$').match
+        stats = self.stats
+        before_lines = self._before_lines
+        for line in lines:
+            if decode_all or has_0x(line) or maybe_separator(line):
+                yield from self._process(line.decode(errors='replace'))
+                continue
+            stats.lines += 1
+            if self._current_backtrace:
+                yield from self._process_unmatched(line, True)
+            # the common case, inlined
+            elif before_lines > 0:
+                self._before_lines_queue.append(line)
+            elif before_lines < 0:
+                yield {'type': self.RecordType.LINE, 'line': line}
+        record = self._flush_current_backtrace()
+        if record is not None:
+            yield record
+
+    def follow_lines(
+        self,
+        lines: Iterable[Optional[str]],
+        flush_timeout: float,
+        max_idle: float = DEFAULT_MAX_IDLE,
+    ) -> Iterator[Record]:
+        """The flavour of process_lines() for live input, see follow_file().
+
+        A None line means that no input was available for a while. The
+        pending backtrace is then completed once no line was seen for
+        flush_timeout seconds, rather than waiting for the next line not
+        belonging to it, which may take arbitrarily long to come. The module
+        resolvers unused for max_idle seconds are closed meanwhile.
+        """
+        last_line = time.monotonic()
+        for line in lines:
+            if line is None:
+                self.close_idle_resolvers(max_idle)
+                if self._current_backtrace and time.monotonic() - last_line >= flush_timeout:
+                    record = self._flush_current_backtrace()
+                    if record is not None:
+                        yield record
+                continue
+            last_line = time.monotonic()
+            yield from self._process(line)
+        record = self._flush_current_backtrace()
+        if record is not None:
+            yield record
+
+    async def _resolve_record(self, record: Record) -> Record:
+        if record['type'] == self.RecordType.BACKTRACE and not record['duplicate']:
+            loop = asyncio.get_running_loop()
+            record['resolved'] = await loop.run_in_executor(
+                None, self.resolve_addresses, record['frames']
+            )
+        return record
+
+    async def aprocess_lines(
+        self, lines: AsyncIterable[str], queue_size: int = 1024
+    ) -> AsyncIterator[Record]:
+        """The asyncio flavour of process_lines().
+
+        Input is read by a separate task while backtraces are being resolved
+        on an executor thread, so reading overlaps with resolution.
+        """
+        queue: asyncio.Queue[Optional[str]] = asyncio.Queue(queue_size)
+
+        async def read():
+            try:
+                async for line in lines:
+                    await queue.put(line)
+            finally:
+                await queue.put(None)
+
+        reader = asyncio.create_task(read())
+        try:
+            while (line := await queue.get()) is not None:
+                for record in self._process(line, resolve=False):
+                    yield await self._resolve_record(record)
+            last = self._flush_current_backtrace(resolve=False)
+            if last is not None:
+                yield await self._resolve_record(last)
+            await reader
+        finally:
+            reader.cancel()
+
+    def __call__(self, line: str):
+        for record in self._process(line):
+            self.print_record(record)
+
+
+class ResolverServer(socketserver.ThreadingUnixStreamServer):
+    """Serves address resolution requests over a Unix domain socket.
+
+    This allows tools to share warm resolvers (addr2line processes, loaded
+    symbols, kallsyms) instead of starting their own on each invocation.
+
+    The protocol is line based: each request is a JSON object on a line of
+    its own, answered by a JSON object on a line of its own, and a connection
+    can carry any number of requests:
+      request:  {"options": {...}, "frames": [[module, address], ...]}
+      response: {"resolved": [resolved, ...]} or {"error": message}
+    The options are the BacktraceResolver arguments affecting resolution,
+    see OPTIONS, and the resolved frames are in the non-verbose form. Module,
+    kallsyms and vmlinux paths must be absolute, as the server doesn't share
+    the working directory of its clients. The addr2line command is chosen
+    when starting the server, not by clients. A BacktraceResolver is kept for
+    each set of options seen, and resolves the modules of any number of
+    binaries. Module resolvers unused for max_idle seconds are closed.
+    """
+
+    OPTIONS = ('kallsyms', 'vmlinux', 'kernel_offset', 'concise', 'backend')
+
+    # the options holding paths, see above
+    PATH_OPTIONS = ('kallsyms', 'vmlinux')
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        path: str,
+        symbol_cache: Optional[str] = None,
+        max_resolvers: int = 0,
+        debug: bool = False,
+        cmd_path: str = 'addr2line',
+        max_idle: float = DEFAULT_MAX_IDLE,
+    ):
+        super().__init__(path, _ResolverRequestHandler)
+        self._path = path
+        self._cmd_path = cmd_path
+        self._max_idle = max_idle
+        self._symbol_cache = symbol_cache
+        self._max_resolvers = max_resolvers
+        self._debug = debug
+        self._lock = threading.Lock()
+        # resolvers keyed by their (JSON encoded) options, each with a lock
+        # serializing their use
+        self._resolvers: dict[str, tuple[BacktraceResolver, threading.Lock]] = {}
+
+    def resolve(self, options: dict[str, Any], frames: list[tuple[str, str]]) -> list[str]:
+        unknown = set(options) - set(self.OPTIONS)
+        if unknown:
+            raise ValueError(f"unknown options: {', '.join(sorted(unknown))}")
+        for option in self.PATH_OPTIONS:
+            if options.get(option) is not None and not os.path.isabs(options[option]):
+                raise ValueError(f'{option} is not an absolute path: {options[option]}')
+        for module in {module for module, _ in frames}:
+            if module in (KERNEL_MODULE, UNKNOWN_EXECUTABLE):
+                continue
+            if not os.path.isabs(module):
+                raise ValueError(f'module is not an absolute path: {module}')
+            if not os.access(module, os.R_OK):
+                raise FileNotFoundError(f'cannot open module: {module}')
+        key = json.dumps(options, sort_keys=True)
+        with self._lock:
+            if key not in self._resolvers:
+                resolver = BacktraceResolver(
+                    executable='',
+                    debug=self._debug,
+                    symbol_cache=self._symbol_cache,
+                    max_resolvers=self._max_resolvers,
+                    cmd_path=self._cmd_path,
+                    **options,
+                )
+                self._resolvers[key] = (resolver, threading.Lock())
+            resolver, lock = self._resolvers[key]
+        with lock:
+            return resolver.resolve_addresses(frames, verbose=False)
+
+    def service_actions(self):
+        # called by serve_forever() on each poll, i.e., at least every 0.5s
+        with self._lock:
+            resolvers = list(self._resolvers.values())
+        for resolver, lock in resolvers:
+            # a resolver busy with a request is not idle anyway
+            if lock.acquire(blocking=False):
+                try:
+                    resolver.close_idle_resolvers(self._max_idle)
+                finally:
+                    lock.release()
+
+    def server_close(self):
+        super().server_close()
+        with self._lock:
+            for resolver, lock in self._resolvers.values():
+                with lock:
+                    resolver.close()
+            self._resolvers = {}
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+
+class _ResolverRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = cast(ResolverServer, self.server)
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = {
+                    'resolved': server.resolve(request.get('options', {}), request['frames'])
+                }
+            except Exception as e:
+                response = {'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class ResolverClient:
+    """A connection to a ResolverServer, see BacktraceResolver(server=...).
+
+    Relative paths are made absolute before being sent to the server, which
+    would otherwise resolve them against its own working directory.
+    """
+
+    def __init__(self, path: str, options: dict[str, Any]):
+        self._options = {
+            option: (
+                os.path.abspath(value)
+                if option in ResolverServer.PATH_OPTIONS and value is not None
+                else value
+            )
+            for option, value in options.items()
+        }
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(path)
+        except OSError:
+            self._socket.close()
+            raise
+        self._file = self._socket.makefile('rwb')
+
+    def resolve(self, frames: list[tuple[str, str]]) -> list[str]:
+        frames = [
+            (
+                (
+                    module
+                    if module in (KERNEL_MODULE, UNKNOWN_EXECUTABLE)
+                    else os.path.abspath(module)
+                ),
+                address,
+            )
+            for module, address in frames
+        ]
+        request = {'options': self._options, 'frames': frames}
+        self._file.write(json.dumps(request).encode() + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('the resolver server closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError(f"resolver server error: {response['error']}")
+        return response['resolved']
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+def serve(
+    path: str,
+    symbol_cache: Optional[str] = None,
+    max_resolvers: int = 0,
+    debug: bool = False,
+    cmd_path: str = 'addr2line',
+    max_idle: float = DEFAULT_MAX_IDLE,
+):
+    """Runs a ResolverServer on path until interrupted. Must be called from the main thread."""
+    if os.path.exists(path):
+        # remove a stale socket, but don't steal the one of a running server
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        else:
+            raise RuntimeError(f'a resolver server is already running on {path}')
+        finally:
+            probe.close()
+    # stop (and clean up) on SIGTERM as well
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with ResolverServer(path, symbol_cache, max_resolvers, debug, cmd_path, max_idle) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+# the resolver of a preresolve() worker process
+_worker_resolver: Optional[BacktraceResolver] = None
+
+
+def _preresolve_worker_init(config: dict[str, Any]):
+    global _worker_resolver
+    _worker_resolver = BacktraceResolver(**config)
+
+
+def _preresolve_worker(module: str, addresses: list[str]) -> tuple[dict[str, str], float]:
+    """Resolves a shard of addresses, returning their resolutions and the time it took,
+    not counting the setup of the module resolver, as in _resolve_module_addresses()."""
+    resolver = notNone(_worker_resolver)
+    resolver._get_resolver_for_module(module).start()
+    start = time.perf_counter()
+    resolved = resolver._resolve_module_addresses(module, addresses)
+    return resolved, time.perf_counter() - start
@@ -1,13 +1,29 @@
 #!/usr/bin/env python
 
 import argparse
+import bisect
+import calendar
+import concurrent.futures
+import contextlib
+import io
+import json
+import math
+import mmap
+import os
+import random
+import struct
 import sys
 import re
+import tempfile
+import time
+import unittest
+import zlib
 
 import addr2line
+from array import array
 from collections import defaultdict
 from itertools import chain, dropwhile
-from typing import Iterator, Self
+from typing import Any, Callable, Iterable, Iterator, Optional
 
 
 def get_command_line_parser():
@@ -47,104 +63,93 @@ def get_command_line_parser():
                         help='Process only stalls lasting the given time, in milliseconds, or longer')
     parser.add_argument('-b', '--branch-threshold', type=float, default=0.03,
                         help='Drop branches responsible for less than this threshold relative to the previous level, not global. (default 3%%)')
-    parser.add_argument('--format', choices=['graph', 'trace'], default='graph',
-                        help='The output format, default is %(default)s. `trace` is suitable as input for flamegraph.pl')
+    parser.add_argument('--format', choices=['graph', 'trace', 'flamegraph-html'], default='graph',
+                        help='The output format, default is %(default)s. `trace` is suitable as input for flamegraph.pl, '
+                            'and `flamegraph-html` is a self-contained page with an interactive flame graph of the stall times, '
+                            'which can be zoomed and searched')
+    parser.add_argument('--min-width', type=float, default=0.1, metavar='PCT',
+                        help='With --format=flamegraph-html, omit the frames accounting for less than PCT percent '
+                            'of the total stall time. Default is %(default)s.')
     parser.add_argument('-a', '--addr2line', default='llvm-addr2line',
                         help='The path or name of the addr2line command, which should behave as and '
                             'accept the same options as binutils addr2line or llvm-addr2line (the default).')
-    parser.add_argument('file', nargs='?',
-                        type=argparse.FileType('r'),
-                        default=sys.stdin,
-                        help='File containing reactor stall backtraces. Read from stdin if missing.')
+    parser.add_argument('--backend', choices=['addr2line', 'native'], default='addr2line',
+                        help='How to resolve addresses: by piping them to the addr2line command (the default), '
+                            'or by loading the symbol table and DWARF debug info of the binaries in-process '
+                            '(native, requires pyelftools).')
+    parser.add_argument('--max-resolvers', type=int, default=0,
+                        help='Keep at most this many module resolvers (e.g., addr2line processes) alive, '
+                            'closing the least recently used one when another is needed (0=unlimited)')
+    parser.add_argument('--symbol-cache', action='store_true', default=False,
+                        help='Keep resolved addresses in a persistent cache keyed by the Build-ID of the binaries, '
+                            'so that repeated runs skip addr2line for addresses seen before.')
+    parser.add_argument('--symbol-cache-file', default=addr2line.default_symbol_cache_path(),
+                        help='The sqlite database backing --symbol-cache. Default is %(default)s.')
+    parser.add_argument('--server', metavar='SOCKET',
+                        help='Resolve addresses with the seastar-addr2line server listening on SOCKET '
+                            '(see seastar-addr2line --serve) instead of starting resolvers.')
+    parser.add_argument('--shard-stats', action='store_true', default=False,
+                        help='Print the count, total, p50, p99 and max stall time of each shard')
+    parser.add_argument('--window', type=parse_window, default=0, metavar='DURATION',
+                        help='Print the stall stats by time window of DURATION seconds, or with an s/m/h/d suffix '
+                            '(e.g., 1m), by the ISO 8601 or syslog timestamps of the stall lines (taken as UTC)')
+    parser.add_argument('--top', type=int, default=0, metavar='N',
+                        help='Print the N shards, or shard and time window pairs with --window, '
+                            'with the largest total stall time')
+    parser.add_argument('--save-state', metavar='FILE',
+                        help='Save the stall tally and graph (or collapsed stacks, for --format=trace) to FILE, '
+                            'to be loaded with --load-state.')
+    parser.add_argument('--load-state', metavar='FILE', action='append',
+                        help='Merge the state saved with --save-state to FILE before processing the input files, '
+                            'which are then only read from stdin when given as "-". Can be given multiple times, '
+                            'e.g., to merge daily states. The state must be saved with the same --format.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Parse the input files with this many worker processes, splitting uncompressed files '
+                            'at line boundaries, and merge their graphs. Default is 1, parsing them in-process.')
+    parser.add_argument('--diff', metavar='BASELINE',
+                        help='Print the changes from BASELINE, a log or a state saved with --save-state, instead of '
+                            'the graph: by address (or function, with --executable) and by link, sorted by the change '
+                            'in total stall time. With --format=trace, print each stack with its count in BASELINE '
+                            'and in the input, as expected by flamegraph.pl for differential flame graphs.')
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='Self-test')
+    parser.add_argument('file', nargs='*',
+                        help='Files containing reactor stall backtraces, possibly gzip or zstd compressed. '
+                            'Read from stdin if missing or "-".')
     return parser
 
 
-class Node:
-    def __init__(self, addr: str):
-        self.addr = addr
-        x = addr.find('+')
-        if x >= 0:
-            self.addr_only = addr[x + 1:]
-            self.module = addr[:x]
-        else:
-            self.addr_only = addr
-            self.module = None
-        self.callers = {}
-        self.callees = {}
-        self.printed = False
-
-    def __repr__(self):
-        return f"Node({self.addr})"
-
-    class Link:
-        def __init__(self, node: "Node", t: int) -> None:
-            self.node = node
-            self.total = t
-            self.count = 1
-
-        def __eq__(self, other: Self) -> bool:
-            return self.total == other.total and self.count == other.count
-
-        def __ne__(self, other: Self):
-            return not (self == other)
-
-        def __lt__(self, other: Self) -> bool:
-            return self.total < other.total or self.total == other.total and self.count < other.count
-
-        def add(self, t: int) -> bool:
-            self.total += t
-            self.count += 1
-
-    def link_caller(self, t: int, n: Self) -> Self:
-        if n.addr in self.callers:
-            link = self.callers[n.addr]
-            link.add(t)
-            n.callees[self.addr].add(t)
-        else:
-            self.callers[n.addr] = self.Link(n, t)
-            n.callees[self.addr] = self.Link(self, t)
-        return n
-
-    def unlink_caller(self, addr: str) -> None:
-        link = self.callers.pop(addr)
-        link.node.callees.pop(self.addr)
-
-    def link_callee(self, t: int, n) -> Self:
-        if n.addr in self.callees:
-            link = self.callees[n.addr]
-            link.add(t)
-            n.callers[self.addr].add(t)
-        else:
-            self.callees[n.addr] = self.Link(n, t)
-            n.callers[self.addr] = self.Link(self, t)
-        return n
-
-    def unlink_callee(self, addr: str) -> None:
-        link = self.callees.pop(addr)
-        link.node.callers.pop(self.addr)
-
-    def sorted_links(self, links: list, descending=True) -> list:
-        return sorted([l for l in links if l.node.addr], reverse=descending)
-
-    def sorted_callers(self, descending=True) -> list:
-        return self.sorted_links(self.callers.values(), descending)
-
-    def sorted_callees(self, descending=True) -> list:
-        return self.sorted_links(self.callees.values(), descending)
+class Graph:
+    # The graph is kept compact, to scale to many millions of backtraces:
+    # nodes are interned to integer ids, indexing addrs, and each link is an
+    # entry of edges keyed by caller_id << 32 | callee_id, holding the packed
+    # total << 32 | count of the stalls passing through it. The backtraces
+    # are linked to two pseudo nodes: their innermost frames are callers of
+    # the tail, and their outermost frames are callees of the head.
+    TAIL = 0
+    HEAD = 1
+    ID_BITS = 32
+    ID_MASK = (1 << ID_BITS) - 1
+    COUNT_BITS = 32
+    COUNT_MASK = (1 << COUNT_BITS) - 1
 
+    __slots__ = ('resolver', 'addrs', 'ids', 'edges', 'has_callees', 'traces', 'trace_ids', 'times')
 
-class Graph:
     def __init__(self, resolver: addr2line.BacktraceResolver):
         self.resolver = resolver
-        # Each node in the tree contains:
-        self.count = 0
-        self.total = 0
-        self.nodes = dict[str, Node]()
-        self.tail = Node('')
-        self.head = Node('')
+        self.addrs = ['', '']
+        self.ids = dict[str, int]()
+        self.edges = dict[int, int]()
+        # whether a node has callees other than the tail, by id
+        self.has_callees = bytearray(2)
+        # the space separated backtraces processed since the graph was last
+        # built (see process_trace()), mapped to their [id, total, count,
+        # index of the last stall], and the backtrace id and time of each stall
+        self.traces = dict[str, list[int]]()
+        self.trace_ids = array('I')
+        self.times = array('Q')
 
     def empty(self):
-        return not self.nodes
+        return not self.ids and not self.traces
 
     def __bool__(self):
         return not self.empty()
@@ -159,29 +164,223 @@ class Graph:
         # This helps identifying closely related reactor stalls
         # where a code path that stalls may be called from multiple
         # call sites.
-        node = None
-        for addr in trace:
-            node = self.add(node, t, addr)
-        self.add_head(t, node)
-
-    def add(self, prev: Node, t: int, addr: str):
-        if addr in self.nodes:
-            n = self.nodes[addr]
+        #
+        # Identical backtraces are aggregated here, and inserted once
+        # each, with their total and count, by _build().
+        i = len(self.trace_ids)
+        key = ' '.join(trace)
+        aggregated = self.traces.get(key)
+        if aggregated is None:
+            aggregated = self.traces[key] = [len(self.traces), 0, 0, i]
+        aggregated[1] += t
+        aggregated[2] += 1
+        aggregated[3] = i
+        self.trace_ids.append(aggregated[0])
+        self.times.append(t)
+
+    def _build(self) -> None:
+        # Insert the backtraces aggregated by process_trace() into the graph,
+        # in the order they first appeared, as if they were inserted one by
+        # one: the links between nodes and to the tail add up regardless of
+        # the order of the backtraces, but a node loses its head link
+        # whenever it is called (see add()), so the head links only count
+        # the stalls since the last one calling their node.
+        if not self.traces:
+            return
+        outermost = []
+        # the index of the last stall calling each node
+        called = {}
+        for trace, (_, total, count, last) in self.traces.items():
+            node = None
+            for addr in trace.split():
+                if node is not None:
+                    called[node] = max(called.get(node, -1), last)
+                node = self.add(node, total, addr, count)
+            outermost.append(node)
+        if not any(n in called for n in outermost):
+            # usually, no outermost node is ever called, and keeps all its stalls
+            for (_, total, count, _), n in zip(self.traces.values(), outermost):
+                self.add_head(total, n, count)
         else:
-            n = Node(addr)
-            self.nodes[addr] = n
-        if prev:
-            if prev.addr in self.head.callees:
-                self.head.unlink_callee(prev.addr)
-            prev.link_caller(t, n)
-            if addr in self.tail.callers:
-                self.tail.unlink_caller(addr)
-        elif not n.callees or addr in self.tail.callers:
-            self.tail.link_caller(t, n)
+            for i, (trace_id, t) in enumerate(zip(self.trace_ids, self.times)):
+                n = outermost[trace_id]
+                if i >= called.get(n, -1):
+                    self.add_head(t, n)
+        self.traces.clear()
+        self.trace_ids = array('I')
+        self.times = array('Q')
+
+    def link(self, caller: int, callee: int, t: int, count: int = 1) -> None:
+        key = caller << self.ID_BITS | callee
+        edges = self.edges
+        edges[key] = edges.get(key, 0) + (t << self.COUNT_BITS | count)
+
+    def unlink(self, caller: int, callee: int) -> None:
+        self.edges.pop(caller << self.ID_BITS | callee, None)
+
+    def add(self, prev: Optional[int], t: int, addr: str, count: int = 1) -> int:
+        n = self.node(addr)
+        if prev is not None:
+            self.unlink(self.HEAD, prev)
+            self.link(n, prev, t, count)
+            self.has_callees[n] = 1
+            self.unlink(n, self.TAIL)
+        elif not self.has_callees[n]:
+            self.link(n, self.TAIL, t, count)
+        return n
+
+    def add_head(self, t: int, n: int, count: int = 1):
+        self.link(self.HEAD, n, t, count)
+
+    def node(self, addr: str) -> int:
+        n = self.ids.get(addr)
+        if n is None:
+            n = len(self.addrs)
+            self.ids[addr] = n
+            self.addrs.append(addr)
+            self.has_callees.append(0)
         return n
 
-    def add_head(self, t: int, n: Node):
-        self.head.link_callee(t, n)
+    def save(self) -> bytes:
+        # node ids are saved as indexes of the saved addresses, past the pseudo nodes
+        self._build()
+        edges, heads, tails = [], [], []
+        for key, value in self.edges.items():
+            caller, callee = key >> self.ID_BITS, key & self.ID_MASK
+            link = (value >> self.COUNT_BITS, value & self.COUNT_MASK)
+            if caller == self.HEAD:
+                heads.append((callee - 2, *link))
+            elif callee == self.TAIL:
+                tails.append((caller - 2, *link))
+            else:
+                edges.append((caller - 2, callee - 2, *link))
+        return b''.join([_pack_strings(self.addrs[2:]),
+                         _pack_columns(edges, 'IIQQ'),
+                         _pack_columns(heads, 'IQQ'),
+                         _pack_columns(tails, 'IQQ')])
+
+    def load(self, data: memoryview) -> memoryview:
+        # Merge a graph saved by save() into this one, as if its backtraces
+        # were processed after those of this graph (see add()), returning the
+        # remaining data:
+        # - a node called in the saved graph loses its head link, and gets
+        #   the head link it has there, if any
+        # - a node with callees is never linked to the tail
+        self._build()
+        addrs, data = _unpack_strings(data)
+        nodes = array('I', (self.node(addr) for addr in addrs))
+        (callers, callees, totals, counts), data = _unpack_columns(data, 'IIQQ')
+        for i in set(callees):
+            self.unlink(self.HEAD, nodes[i])
+        for caller, callee, t, count in zip(callers, callees, totals, counts):
+            self.link(nodes[caller], nodes[callee], t, count)
+            self.has_callees[nodes[caller]] = 1
+        (heads, totals, counts), data = _unpack_columns(data, 'IQQ')
+        for i, t, count in zip(heads, totals, counts):
+            self.link(self.HEAD, nodes[i], t, count)
+        for i in set(callers):
+            self.unlink(nodes[i], self.TAIL)
+        (tails, totals, counts), data = _unpack_columns(data, 'IQQ')
+        for i, t, count in zip(tails, totals, counts):
+            if not self.has_callees[nodes[i]]:
+                self.link(nodes[i], self.TAIL, t, count)
+        return data
+
+    def _links(self, callees: bool) -> Callable[[int], list[tuple[int, int, int]]]:
+        # Returns a function listing the (node, total, count) callees, or
+        # callers, of a node, in descending (total, count) order. The links
+        # are grouped by node by sorting the edge keys once, keeping the
+        # order in which they were added among equal links.
+        shift, mask = self.ID_BITS, self.ID_MASK
+        edges = self.edges
+        if callees:
+            group, other = (lambda key: key >> shift), (lambda key: key & mask)
+        else:
+            group, other = (lambda key: key & mask), (lambda key: key >> shift)
+        keys = sorted(edges, key=group)
+        groups = array('I', map(group, keys))
+
+        def links(n: int) -> list[tuple[int, int, int]]:
+            lo = bisect.bisect_left(groups, n)
+            hi = bisect.bisect_right(groups, n, lo)
+            result = []
+            for key in sorted(keys[lo:hi], key=edges.__getitem__, reverse=True):
+                m = other(key)
+                # skip the pseudo nodes
+                if m > self.HEAD:
+                    value = edges[key]
+                    result.append((m, value >> self.COUNT_BITS, value & self.COUNT_MASK))
+            return result
+
+        return links
+
+    def link_totals(self) -> dict[tuple[str, str], int]:
+        # the packed total and count of the links between addresses, by (caller, callee)
+        self._build()
+        addrs = self.addrs
+        return {(addrs[key >> self.ID_BITS], addrs[key & self.ID_MASK]): value
+                for key, value in self.edges.items()
+                if key >> self.ID_BITS > self.HEAD and key & self.ID_MASK > self.HEAD}
+
+    def node_totals(self) -> dict[str, int]:
+        # The packed total and count of the stalls through each address: the
+        # larger of the sums of its links to callers and to callees, since the
+        # links to the head and the tail are dropped once an address is called
+        # by, or calls, another one (see add()).
+        self._build()
+        callers = defaultdict(int)
+        callees = defaultdict(int)
+        for key, value in self.edges.items():
+            callees[key >> self.ID_BITS] += value
+            callers[key & self.ID_MASK] += value
+        return {addr: max(callers[n], callees[n]) for addr, n in self.ids.items()}
+
+    def print_diff(self, base: 'Graph', width: int) -> None:
+        # print the changes in stall time and count from the base graph, by
+        # address (or function, when resolving addresses) and by link
+        self._build()
+        base._build()
+        names = {}
+        if self.resolver:
+            addrs = set(self.ids) | set(base.ids)
+            self.resolver.resolve_addresses(addr2line.split_frame(addr) for addr in addrs)
+            for addr in addrs:
+                module, addr_only = addr2line.split_frame(addr)
+                frames = addr2line.split_resolved_address(self.resolver.resolve_address(addr_only, module=module))
+                names[addr] = frames[0]['function'] if frames and frames[0]['function'] else addr
+
+        def _print_changes(title: str, totals: dict, base_totals: dict) -> None:
+            changes = []
+            for key in totals.keys() | base_totals.keys():
+                value, base_value = totals.get(key, 0), base_totals.get(key, 0)
+                total, count = value >> self.COUNT_BITS, value & self.COUNT_MASK
+                base_total, base_count = base_value >> self.COUNT_BITS, base_value & self.COUNT_MASK
+                if total != base_total or count != base_count:
+                    changes.append((total - base_total, count - base_count, total, count, base_total, base_count, key))
+            print(f"\n{title}, sorted by the change in total stall time:")
+            if not changes:
+                print("No changes")
+            for delta_total, delta_count, total, count, base_total, base_count, key in sorted(changes, reverse=True):
+                label = key if isinstance(key, str) else ' -> '.join(key)
+                self.smart_print(f"[{delta_total:+} ms {delta_count:+}] total={total} count={count} "
+                                 f"baseline_total={base_total} baseline_count={base_count} {label}", width)
+
+        def _by_name(totals: dict) -> dict:
+            merged = defaultdict(int)
+            for addr, value in totals.items():
+                merged[names.get(addr, addr)] += value
+            return merged
+
+        def _links_by_name(totals: dict) -> dict:
+            merged = defaultdict(int)
+            for (caller, callee), value in totals.items():
+                merged[(names.get(caller, caller), names.get(callee, callee))] += value
+            return merged
+
+        _print_changes(f"Changes by {'function (summed over its addresses)' if names else 'address'}",
+                       _by_name(self.node_totals()), _by_name(base.node_totals()))
+        _print_changes("Changes by caller -> callee link",
+                       _links_by_name(self.link_totals()), _links_by_name(base.link_totals()))
 
     def smart_print(self, lines: str, width: int):
         def _print(l: str, width: int):
@@ -204,6 +403,7 @@ class Graph:
                 _print(l, width)
 
     def print_graph(self, direction: str, width: int, branch_threshold: float):
+        self._build()
         top_down = (direction == 'top-down')
         print(f"""
 This graph is printed in {direction} order, where {'callers' if top_down else 'callees'} are printed first.
@@ -222,7 +422,10 @@ Use --direction={'bottom-up' if top_down else 'top-down'} to print {'callees' if
                 prefix += p
             return prefix
 
-        def _recursive_print_graph(n: Node, total: int = 0, count: int = 0, level: int = -1, idx: int = 0, out_of: int = 0, rel: float = 1.0, prefix_list: list[str] = [], skip_stats: bool = False):
+        sorted_links = self._links(callees=top_down)
+        printed = bytearray(len(self.addrs))
+
+        def _recursive_print_graph(n: int, total: int = 0, count: int = 0, level: int = -1, idx: int = 0, out_of: int = 0, rel: float = 1.0, prefix_list: list[str] = [], skip_stats: bool = False):
             nonlocal top_down
             if level >= 0:
                 avg = round(total / count) if count else 0
@@ -236,10 +439,12 @@ Use --direction={'bottom-up' if top_down else 'top-down'} to print {'callees' if
                     stats = ''
                 else:
                     stats = f" total={total} count={count} avg={avg}"
-                l = f"{prefix}{p}{l} addr={n.addr}{stats}"
+                addr = self.addrs[n]
+                l = f"{prefix}{p}{l} addr={addr}{stats}"
                 p = "| "
                 if self.resolver:
-                    lines = self.resolver.resolve_address(n.addr_only, module=n.module).splitlines()
+                    module, addr_only = addr2line.split_frame(addr)
+                    lines = self.resolver.resolve_address(addr_only, module=module).splitlines()
                     if len(lines) == 1:
                         li = lines[0]
                         if li.startswith("??"):
@@ -253,33 +458,33 @@ Use --direction={'bottom-up' if top_down else 'top-down'} to print {'callees' if
                         for li in lines:
                             l += f"{prefix}{p}{' '*cont_indent}{li.strip()}\n"
                 self.smart_print(l, width)
-                if n.printed:
-                    print(f"{prefix}-> continued at addr={n.addr} above")
+                if printed[n]:
+                    print(f"{prefix}-> continued at addr={addr} above")
                     return
-                n.printed = True
-            next = n.sorted_callees() if top_down else n.sorted_callers()
+                printed[n] = 1
+            next = sorted_links(n)
             if not next:
                 return
-            link = next[0]
-            if level >= 0 and len(next) == 1 and link.total == total and link.count == count:
-                _recursive_print_graph(link.node, link.total, link.count, level, idx, out_of, rel, prefix_list, skip_stats=True)
+            link_node, link_total, link_count = next[0]
+            if level >= 0 and len(next) == 1 and link_total == total and link_count == count:
+                _recursive_print_graph(link_node, link_total, link_count, level, idx, out_of, rel, prefix_list, skip_stats=True)
             else:
-                total = sum(link.total for link in next)
+                total = sum(link_total for _, link_total, _ in next)
                 next_prefix_list = prefix_list + ["| " if idx < out_of else "  "] if level >= 0 else []
                 i = 1
                 last_idx = len(next)
                 omitted_idx = 0
                 omitted_total = 0
                 omitted_count = 0
-                for link in next:
-                    rel = link.total / total
+                for link_node, link_total, link_count in next:
+                    rel = link_total / total
                     if rel < branch_threshold:
                         if not omitted_idx:
                             omitted_idx = i
-                        omitted_total += link.total
-                        omitted_count += link.count
+                        omitted_total += link_total
+                        omitted_count += link_count
                     else:
-                        _recursive_print_graph(link.node, link.total, link.count, level + 1, i, last_idx, rel, next_prefix_list)
+                        _recursive_print_graph(link_node, link_total, link_count, level + 1, i, last_idx, rel, next_prefix_list)
                     i += 1
                 if omitted_idx:
                     prefix = _prefix(next_prefix_list)
@@ -289,7 +494,7 @@ Use --direction={'bottom-up' if top_down else 'top-down'} to print {'callees' if
                     l = f"[{level+1}#{omitted_idx}/{last_idx} {round(100*rel)}%]"
                     print(f"{prefix}{p}{l} {last_idx - omitted_idx + 1} more branches total={omitted_total} count={omitted_count} avg={avg}")
 
-        r = self.head if top_down else self.tail
+        r = self.HEAD if top_down else self.TAIL
         _recursive_print_graph(r)
 
 
@@ -313,6 +518,18 @@ class StackCollapse:
         # in ms, but we use it for the count of samples.
         self.collapsed[';'.join(frames)] += count
 
+    def save(self) -> bytes:
+        return _pack_strings(list(self.collapsed)) + _pack_columns([(count,) for count in self.collapsed.values()], 'Q')
+
+    def load(self, data: memoryview) -> memoryview:
+        # merge the collapsed stacks saved by save(), returning the remaining data
+        stacks, data = _unpack_strings(data)
+        (counts,), data = _unpack_columns(data, 'Q')
+        collapsed = self.collapsed
+        for stack, count in zip(stacks, counts):
+            collapsed[stack] += count
+        return data
+
     def _annotate_func(self, line: str) -> str:
         # sample input:
         #   (inlined by) position_in_partition::tri_compare::operator() at ././position_in_partition.hh:485
@@ -335,14 +552,482 @@ class StackCollapse:
         return func
 
     def _resolve(self, addr: str) -> Iterator[str]:
-        lines = self.resolver.resolve_address(addr).splitlines()
+        if not self.resolver:
+            # without an executable, the frames are the raw addresses, as in the graph
+            return iter((addr,))
+        module, addr_only = addr2line.split_frame(addr)
+        lines = self.resolver.resolve_address(addr_only, module=module).splitlines()
         return (self._annotate_func(line) for line in lines)
 
-    def print_graph(self, *_) -> None:
+    def _folded(self) -> Iterator[tuple[str, int]]:
+        # resolve all the unique addresses in one go, so that _resolve()
+        # below is served from the resolver cache
+        if self.resolver:
+            self.resolver.resolve_addresses(addr2line.split_frame(addr) for stack in self.collapsed
+                                            for addr in dict.fromkeys(stack.split(';')))
         for stack, count in self.collapsed.items():
             frames = filter(lambda frame: frame,
                             chain.from_iterable(self._resolve(addr) for addr in stack.split(';')))
-            print(';'.join(reversed(list(frames))), count)
+            yield ';'.join(reversed(list(frames))), count
+
+    def print_graph(self, *_) -> None:
+        for stack, count in self._folded():
+            print(stack, count)
+
+    def print_flamegraph_html(self, min_width: float) -> None:
+        # the frames of each stack, from the outermost caller, and the total
+        # stall time, as the root of the tree
+        stacks = [(stack.split(';') if stack else [], count) for stack, count in self._folded()]
+        total = sum(count for _, count in stacks)
+        # frames narrower than min_width percent of the total are pruned
+        threshold = total * min_width / 100
+        names = {}
+        data_names = []
+
+        def _name(name: str) -> int:
+            if name not in names:
+                names[name] = len(data_names)
+                data_names.append(name)
+            return names[name]
+
+        def _encode(name: str, count: int, stacks: list, depth: int) -> list:
+            # group the stacks going through this frame by their next frame,
+            # and descend only into the wide enough ones, so that the frames
+            # pruned away are never built. encoded as
+            # [name index, stall ms, children]
+            index = _name(name)
+            children = defaultdict(list)
+            for frames, n in stacks:
+                if len(frames) > depth:
+                    children[frames[depth]].append((frames, n))
+            encoded = []
+            for child_name in sorted(children):
+                child_stacks = children[child_name]
+                child_count = sum(n for _, n in child_stacks)
+                if child_count >= threshold:
+                    encoded.append(_encode(child_name, child_count, child_stacks, depth + 1))
+            return [index, count, encoded]
+
+        tree = _encode('all', total, stacks, 0)
+        data = json.dumps({'names': data_names, 'tree': tree}, separators=(',', ':'))
+        # the JSON is embedded in a <script>
+        print(FLAMEGRAPH_HTML.replace('DATA', data.replace('</', '<\\/'), 1), end='')
+
+    def print_diff(self, base: 'StackCollapse', *_) -> None:
+        # print the stacks with their count in the base and in this one, as
+        # expected by flamegraph.pl (see difffolded.pl), with the largest
+        # regressions first
+        folded = defaultdict(int)
+        for stack, count in self._folded():
+            folded[stack] += count
+        base_folded = defaultdict(int)
+        for stack, count in base._folded():
+            base_folded[stack] += count
+        stacks = folded.keys() | base_folded.keys()
+        for stack in sorted(stacks, key=lambda stack: (base_folded[stack] - folded[stack], stack)):
+            print(stack, base_folded[stack], folded[stack])
+
+
+# The self-contained page of --format=flamegraph-html, where DATA is
+# replaced by the JSON frame tree built by StackCollapse.print_flamegraph_html()
+FLAMEGRAPH_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Reactor stalls</title>
+<style>
+body { margin: 0; padding: 8px; font: 12px Verdana, sans-serif; }
+#header { display: flex; gap: 12px; align-items: center; margin-bottom: 6px; }
+#header h1 { font-size: 16px; margin: 0; flex: 1; }
+#details { height: 16px; margin-top: 4px; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
+canvas { display: block; width: 100%; }
+button, input { font: inherit; }
+</style>
+</head>
+<body>
+<div id="header">
+<h1>Reactor stalls</h1>
+<span id="matched"></span>
+<button id="reset" disabled>Reset zoom</button>
+<input id="search" type="search" placeholder="Search (regex)" size="30">
+</div>
+<canvas id="canvas"></canvas>
+<div id="details"></div>
+<script>
+"use strict";
+const data = DATA;
+const FRAME_HEIGHT = 16;
+const canvas = document.getElementById("canvas");
+const ctx = canvas.getContext("2d");
+const details = document.getElementById("details");
+const reset = document.getElementById("reset");
+const search = document.getElementById("search");
+const matched = document.getElementById("matched");
+
+// expand the [name index, stall ms, children] tree
+let maxDepth = 0;
+function expand(node, parent, depth) {
+  const frame = {name: data.names[node[0]], value: node[1], parent: parent, depth: depth, children: []};
+  maxDepth = Math.max(maxDepth, depth);
+  for (const child of node[2]) {
+    frame.children.push(expand(child, frame, depth + 1));
+  }
+  return frame;
+}
+const root = expand(data.tree, null, 0);
+let zoomed = root;
+let pattern = null;
+let boxes = [];
+
+function color(frame) {
+  if (pattern && pattern.test(frame.name)) {
+    return "rgb(230,0,230)";
+  }
+  let hash = 0;
+  for (let i = 0; i < frame.name.length; i++) {
+    hash = (hash * 31 + frame.name.charCodeAt(i)) | 0;
+  }
+  const v = (hash >>> 0) / 4294967296;
+  if (frame.name.endsWith("_[i]")) {
+    return `rgb(${Math.round(50 + 60 * v)},${Math.round(190 + 40 * v)},${Math.round(190 + 40 * v)})`;
+  }
+  return `rgb(${Math.round(205 + 50 * v)},${Math.round(80 + 150 * (1 - v))},${Math.round(55 * v)})`;
+}
+
+function describe(frame) {
+  const pct = (100 * frame.value / root.value).toFixed(2);
+  return `${frame.name} (${frame.value} ms, ${pct}%)`;
+}
+
+function draw() {
+  const width = canvas.clientWidth;
+  const height = (maxDepth + 1) * FRAME_HEIGHT;
+  const ratio = window.devicePixelRatio || 1;
+  canvas.width = width * ratio;
+  canvas.height = height * ratio;
+  canvas.style.height = height + "px";
+  ctx.setTransform(ratio, 0, 0, ratio, 0, 0);
+  ctx.font = "11px Verdana, sans-serif";
+  ctx.textBaseline = "middle";
+  boxes = [];
+  const scale = width / zoomed.value;
+
+  function box(frame, x, w, dimmed) {
+    // the root is at the bottom
+    const y = height - (frame.depth + 1) * FRAME_HEIGHT;
+    ctx.globalAlpha = dimmed ? 0.5 : 1;
+    ctx.fillStyle = color(frame);
+    ctx.fillRect(x, y, w - 1, FRAME_HEIGHT - 1);
+    if (w > 30) {
+      const chars = Math.floor((w - 6) / 7);
+      const label = frame.name.length > chars ? frame.name.slice(0, Math.max(chars - 2, 0)) + ".." : frame.name;
+      ctx.fillStyle = "black";
+      ctx.fillText(label, x + 3, y + FRAME_HEIGHT / 2);
+    }
+    boxes.push({x: x, y: y, w: w, frame: frame});
+  }
+
+  function subtree(frame, x) {
+    const w = frame.value * scale;
+    if (w < 0.5) {
+      return;
+    }
+    box(frame, x, w, false);
+    for (const child of frame.children) {
+      subtree(child, x);
+      x += child.value * scale;
+    }
+  }
+
+  // the ancestors of the zoomed frame span the whole width
+  for (let frame = zoomed.parent; frame; frame = frame.parent) {
+    box(frame, 0, width, true);
+  }
+  subtree(zoomed, 0);
+  ctx.globalAlpha = 1;
+}
+
+function frameAt(event) {
+  const rect = canvas.getBoundingClientRect();
+  const x = event.clientX - rect.left;
+  const y = event.clientY - rect.top;
+  for (const b of boxes) {
+    if (x >= b.x && x < b.x + b.w && y >= b.y && y < b.y + FRAME_HEIGHT) {
+      return b.frame;
+    }
+  }
+  return null;
+}
+
+canvas.addEventListener("mousemove", event => {
+  const frame = frameAt(event);
+  details.textContent = frame ? describe(frame) : "";
+  canvas.style.cursor = frame ? "pointer" : "default";
+});
+
+canvas.addEventListener("click", event => {
+  const frame = frameAt(event);
+  if (frame) {
+    zoomed = frame;
+    reset.disabled = frame === root;
+    draw();
+  }
+});
+
+reset.addEventListener("click", () => {
+  zoomed = root;
+  reset.disabled = true;
+  draw();
+});
+
+search.addEventListener("input", () => {
+  try {
+    pattern = search.value ? new RegExp(search.value) : null;
+  } catch (e) {
+    return;
+  }
+  matched.textContent = "";
+  if (pattern) {
+    // count each stall once, at its outermost matching frame
+    let total = 0;
+    const walk = frame => {
+      if (pattern.test(frame.name)) {
+        total += frame.value;
+      } else {
+        frame.children.forEach(walk);
+      }
+    };
+    walk(root);
+    matched.textContent = `Matched: ${(100 * total / root.value).toFixed(2)}%`;
+  }
+  draw();
+});
+
+window.addEventListener("resize", draw);
+document.title = details.textContent = describe(root);
+draw();
+</script>
+</body>
+</html>
+"""
+
+
+# the formats of the log timestamps, which are taken as UTC (any offset is ignored):
+TIMESTAMP_PATTERN = re.compile(
+    # ISO 8601, e.g., from `journalctl -o short-iso`, or seastar's logger, e.g., 2024-08-10 12:34:56,123
+    r'(?P<year>\d{4})-(?P<month>\d\d)-(?P<day>\d\d)[T ](?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)'
+    # syslog, e.g., Aug 10 12:34:56, of the current year
+    r'|(?P<mon>Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) +(?P<mday>\d\d?) (?P<time>\d\d:\d\d:\d\d)')
+MONTHS = {name: i + 1 for i, name in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                                'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'))}
+
+
+def parse_timestamp(s: str) -> Optional[int]:
+    # the time of the first timestamp in s, in seconds since the epoch
+    m = TIMESTAMP_PATTERN.search(s)
+    if not m:
+        return None
+    try:
+        if m['year']:
+            return calendar.timegm((int(m['year']), int(m['month']), int(m['day']),
+                                    int(m['hour']), int(m['minute']), int(m['second'])))
+        hour, minute, second = m['time'].split(':')
+        return calendar.timegm((time.gmtime().tm_year, MONTHS[m['mon']], int(m['mday']),
+                                int(hour), int(minute), int(second)))
+    except ValueError:
+        return None
+
+
+def parse_window(s: str) -> int:
+    # a duration in seconds, or with an s/m/h/d suffix
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    try:
+        if s and s[-1] in units:
+            seconds = int(s[:-1]) * units[s[-1]]
+        else:
+            seconds = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid duration: '{s}'")
+    if seconds < 0:
+        raise argparse.ArgumentTypeError(f"invalid duration: '{s}'")
+    return seconds
+
+
+class StallSketch:
+    # A mergeable quantile sketch of stall times, after DDSketch: the times
+    # are counted in bins of exponentially growing width, so that quantiles
+    # are estimated within RELATIVE_ACCURACY of the actual stall time, with
+    # a number of bins logarithmic in the range of the times, however many
+    # there are. The count, total, min and max are exact.
+    RELATIVE_ACCURACY = 0.01
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+
+    __slots__ = ('bins', 'zeros', 'count', 'total', 'min', 'max')
+
+    def __init__(self) -> None:
+        self.bins = dict[int, int]()
+        self.zeros = 0
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    @staticmethod
+    def index(t: int) -> int:
+        # the bin of t > 0, which holds the times in (GAMMA ** (i - 1), GAMMA ** i]
+        return math.ceil(math.log(t) / StallSketch.LOG_GAMMA)
+
+    def add(self, t: int, count: int = 1) -> None:
+        if t > 0:
+            i = self.index(t)
+            self.bins[i] = self.bins.get(i, 0) + count
+        else:
+            self.zeros += count
+        self._add_summary(count, t * count, t, t)
+
+    def _add_summary(self, count: int, total: int, min_time: int, max_time: int) -> None:
+        self.min = min(self.min, min_time) if self.count else min_time
+        self.max = max(self.max, max_time)
+        self.count += count
+        self.total += total
+
+    def merge(self, other: 'StallSketch') -> None:
+        if not other.count:
+            return
+        for i, count in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + count
+        self.zeros += other.zeros
+        self._add_summary(other.count, other.total, other.min, other.max)
+
+    def quantile(self, q: float) -> Optional[int]:
+        if not self.count:
+            return None
+        rank = self.count * q
+        running_count = self.zeros
+        if running_count >= rank:
+            return 0
+        for i in sorted(self.bins):
+            running_count += self.bins[i]
+            if running_count >= rank:
+                # the middle of the bin, relative to its bounds
+                t = round(2 * self.GAMMA ** i / (self.GAMMA + 1))
+                return min(max(t, self.min), self.max)
+        return self.max
+
+
+class StallStats:
+    # Sketches of stall times by shard and time window. Windows are keyed by
+    # their start, in seconds since the epoch. When not bucketing by time all
+    # stalls are in window 0, and when bucketing by time stalls without a
+    # timestamp are in window NO_TIME.
+    NO_TIME = -1
+
+    def __init__(self, window: int = 0) -> None:
+        self.window = window
+        self.buckets = dict[tuple[int, int], StallSketch]()
+
+    def _sketch(self, shard: int, start: int) -> StallSketch:
+        sketch = self.buckets.get((shard, start))
+        if sketch is None:
+            sketch = self.buckets[(shard, start)] = StallSketch()
+        return sketch
+
+    def add(self, shard: int, t: int, line: str) -> None:
+        start = 0
+        if self.window:
+            timestamp = parse_timestamp(line)
+            start = self.NO_TIME if timestamp is None else timestamp - timestamp % self.window
+        self._sketch(shard, start).add(t)
+
+    def _start(self, start: int, window: int) -> int:
+        # the start of the window of this bucketing, given the start of another one
+        if not self.window:
+            return 0
+        if start == self.NO_TIME or window == self.window:
+            return start
+        return start - start % self.window
+
+    def save(self) -> bytes:
+        buckets = []
+        bins = []
+        for n, ((shard, start), sketch) in enumerate(self.buckets.items()):
+            buckets.append((shard, start, sketch.zeros, sketch.total, sketch.min, sketch.max))
+            bins.extend((n, i, count) for i, count in sketch.bins.items())
+        return b''.join([_pack_columns([(self.window,)], 'Q'),
+                         _pack_columns(buckets, 'IqQQQQ'),
+                         _pack_columns(bins, 'IiQ')])
+
+    def load(self, data: memoryview, name: str, version: int = 3) -> memoryview:
+        # merge the stats saved by save(), returning the remaining data
+        (window,), data = _unpack_columns(data, 'Q')
+        window = window[0]
+        if self.window and (not window or self.window % window):
+            raise ValueError(f"{name}: the stats were saved with --window={window}, "
+                             f"which does not divide --window={self.window}")
+        if version < 3:
+            # exact tallies
+            (shards, starts, times, counts), data = _unpack_columns(data, 'IqQQ')
+            for shard, start, t, count in zip(shards, starts, times, counts):
+                self._sketch(shard, self._start(start, window)).add(t, count)
+            return data
+        (shards, starts, zeros, totals, mins, maxs), data = _unpack_columns(data, 'IqQQQQ')
+        sketches = [StallSketch() for _ in shards]
+        for sketch, z, total, min_time, max_time in zip(sketches, zeros, totals, mins, maxs):
+            sketch.zeros = z
+            sketch.total = total
+            sketch.min = min_time
+            sketch.max = max_time
+        (buckets, indexes, counts), data = _unpack_columns(data, 'IiQ')
+        for n, i, count in zip(buckets, indexes, counts):
+            sketches[n].bins[i] = count
+        for shard, start, sketch in zip(shards, starts, sketches):
+            sketch.count = sketch.zeros + sum(sketch.bins.values())
+            self._sketch(shard, self._start(start, window)).merge(sketch)
+        return data
+
+    def by(self, key: Callable[[tuple[int, int]], Any]) -> dict[Any, StallSketch]:
+        # merge the sketches of the buckets with the same key
+        merged = {}
+        for bucket, sketch in self.buckets.items():
+            k = key(bucket)
+            if k not in merged:
+                merged[k] = StallSketch()
+            merged[k].merge(sketch)
+        return merged
+
+
+def print_bucket_stats(stats: StallStats, shard_stats: bool, top: int) -> None:
+    def _window(start: int) -> str:
+        if start == stats.NO_TIME:
+            return 'no-timestamp'
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(start))
+
+    def _print(label: str, sketch: StallSketch) -> None:
+        print(f"{label} count={sketch.count} total={sketch.total} "
+              f"p50={sketch.quantile(0.5)} p99={sketch.quantile(0.99)} max={sketch.max}")
+
+    if shard_stats or stats.window or top:
+        print(f"\nThe percentiles below are estimated within {round(100 * StallSketch.RELATIVE_ACCURACY)}%, "
+              "rounded to the millisecond.")
+    if shard_stats:
+        print("\nStalls by shard:")
+        for shard, sketch in sorted(stats.by(lambda bucket: bucket[0]).items()):
+            _print(f"shard={shard}", sketch)
+    if stats.window:
+        print(f"\nStalls by window of {stats.window}s:")
+        # stalls without a timestamp last
+        windows = stats.by(lambda bucket: bucket[1])
+        for start in sorted(windows, key=lambda start: (start == stats.NO_TIME, start)):
+            _print(f"window={_window(start)}", windows[start])
+    if top:
+        print(f"\nTop {top} {'shard and window pairs' if stats.window else 'shards'} by total stall time:")
+        buckets = sorted(stats.buckets.items(), key=lambda bucket: bucket[1].total, reverse=True)
+        for (shard, start), sketch in buckets[:top]:
+            label = f"shard={shard}"
+            if stats.window:
+                label += f" window={_window(start)}"
+            _print(label, sketch)
 
 
 def print_stats(tally: dict, tmin: int) -> None:
@@ -385,13 +1070,104 @@ def print_stats(tally: dict, tmin: int) -> None:
     print(f"min={min_time} avg={avg_time:.1f} median={median} p95={p95} p99={p99} p999={p999} max={max_time}")
 
 
+# The state saved by --save-state: the magic and version, followed by the
+# zlib compressed output format, stall tally, graph (or collapsed stacks) and
+# stats by shard and window, made of little-endian arrays prefixed by their
+# length. Version 1 states have no stats by shard and window, and version 2
+# states have exact tallies instead of their sketches.
+STATE_MAGIC = b'STALLSTA'
+STATE_VERSION = 3
+
+
+def _pack_columns(rows: list[tuple], typecodes: str) -> bytes:
+    columns = list(zip(*rows)) if rows else [()] * len(typecodes)
+    data = [struct.pack('<I', len(rows))]
+    for typecode, column in zip(typecodes, columns):
+        a = array(typecode, column)
+        if sys.byteorder == 'big':
+            a.byteswap()
+        data.append(a.tobytes())
+    return b''.join(data)
+
+
+def _unpack_columns(data: memoryview, typecodes: str) -> tuple[list[array], memoryview]:
+    n, = struct.unpack_from('<I', data)
+    data = data[4:]
+    columns = []
+    for typecode in typecodes:
+        a = array(typecode)
+        size = n * a.itemsize
+        a.frombytes(data[:size])
+        if sys.byteorder == 'big':
+            a.byteswap()
+        columns.append(a)
+        data = data[size:]
+    return columns, data
+
+
+def _pack_strings(strings: list[str]) -> bytes:
+    # the strings (addresses, stacks) contain no newlines
+    joined = '\n'.join(strings).encode()
+    return struct.pack('<II', len(strings), len(joined)) + joined
+
+
+def _unpack_strings(data: memoryview) -> tuple[list[str], memoryview]:
+    n, size = struct.unpack_from('<II', data)
+    strings = str(data[8:8 + size], 'utf-8').split('\n') if n else []
+    return strings, data[8 + size:]
+
+
+def _state_payload(output_format: str, tally: dict, stats: StallStats, render) -> bytes:
+    data = [_pack_strings([output_format]), _pack_columns(sorted(tally.items()), 'QQ'), render.save(), stats.save()]
+    return b''.join(data)
+
+
+def _merge_payload(data: memoryview, output_format: str, tally: dict, stats: StallStats, render, name: str,
+                   version: int = STATE_VERSION) -> None:
+    (saved_format,), data = _unpack_strings(data)
+    if saved_format != output_format:
+        raise ValueError(f"{name}: the state was saved with --format={saved_format}")
+    (times, counts), data = _unpack_columns(data, 'QQ')
+    for t, count in zip(times, counts):
+        tally[t] = tally.get(t, 0) + count
+    data = render.load(data)
+    # version 1 states have no stats by shard and window
+    if version >= 2:
+        stats.load(data, name, version)
+
+
+def save_state(path: str, output_format: str, tally: dict, stats: StallStats, render) -> None:
+    with open(path, 'wb') as f:
+        f.write(STATE_MAGIC + struct.pack('<I', STATE_VERSION))
+        f.write(zlib.compress(_state_payload(output_format, tally, stats, render)))
+
+
+def is_state(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(STATE_MAGIC)) == STATE_MAGIC
+
+
+def load_state(path: str, output_format: str, tally: dict, stats: StallStats, render) -> None:
+    # merge the state saved by save_state() into the tally and render
+    with open(path, 'rb') as f:
+        data = f.read()
+    header = len(STATE_MAGIC) + 4
+    if not data.startswith(STATE_MAGIC):
+        raise ValueError(f"{path}: not a stall-analyser state")
+    version, = struct.unpack_from('<I', data, len(STATE_MAGIC))
+    if not 1 <= version <= STATE_VERSION:
+        raise ValueError(f"{path}: unsupported state version {version}")
+    _merge_payload(memoryview(zlib.decompress(data[header:])), output_format, tally, stats, render, path, version)
+
+
 def print_command_line_options(args):
     varargs = vars(args)
     clopts = ""
     for k in varargs.keys():
         val = varargs[k]
         opt = re.sub('_', '-', k)
-        if val is None:
+        # lists, i.e. the input files and --load-state, are not printed
+        if val is None or isinstance(val, list):
             continue
         elif not isinstance(val, bool):
             clopts += f" --{opt}={val}"
@@ -400,25 +1176,19 @@ def print_command_line_options(args):
     print(f"Command line options:{clopts}\n")
 
 
-def main():
-    args = get_command_line_parser().parse_args()
-    comment = re.compile(r'^\s*#')
-    pattern = re.compile(r"Reactor stalled for (?P<stall>\d+) ms on shard (?P<shard>\d+).*Backtrace:")
-    expected_input_format = "Expected one or more lines ending with: 'Reactor stalled for <n> ms on shard <i>. Backtrace: <addr> [<addr> ...]'"
-    address_threshold = int(args.address_threshold, 0)
-    # map from stall time in ms to the count of the stall time
-    tally = {}
-    resolver = None
-    if args.executable:
-        resolver = addr2line.BacktraceResolver(executable=args.executable,
-                                               concise=not args.full_function_names,
-                                               cmd_path=args.addr2line)
-    if args.format == 'graph':
-        render = Graph(resolver)
-    else:
-        render = StackCollapse(resolver)
+class InvalidInputLine(Exception):
+    pass
+
+
+COMMENT_PATTERN = re.compile(r'^\s*#')
+STALL_PATTERN = re.compile(r"Reactor stalled for (?P<stall>\d+) ms on shard (?P<shard>\d+).*Backtrace:")
+EXPECTED_INPUT_FORMAT = "Expected one or more lines ending with: 'Reactor stalled for <n> ms on shard <i>. Backtrace: <addr> [<addr> ...]'"
 
-    for s in args.file:
+
+def process_lines(lines: Iterable[bytes], tally: dict, stats: StallStats, render, tmin: int, address_threshold: int) -> None:
+    comment = COMMENT_PATTERN
+    pattern = STALL_PATTERN
+    for s in (line.decode(errors='replace') for line in lines):
         if comment.search(s):
             continue
         # parse log line like:
@@ -431,6 +1201,7 @@ def main():
         t = int(m.group("stall"))
         # and the addresses after "Backtrace:"
         tally[t] = tally.pop(t, 0) + 1
+        stats.add(int(m.group("shard")), t, s)
         # The address_threshold typically indicates a library call
         # and the backtrace up-to and including it are usually of
         # no interest as they all contain the stall backtrace geneneration code, e.g.:
@@ -444,28 +1215,286 @@ def main():
         #  (inlined by) seastar::reactor::block_notifier(int) at ./build/release/seastar/./seastar/src/core/reactor.cc:1240
         # ?? ??:0
         if address_threshold:
-            trace = list(dropwhile(lambda addr: int(addr, 0) >= address_threshold, trace))
-        if t >= args.tmin:
+            trace = list(dropwhile(lambda addr: int(addr2line.split_frame(addr)[1], 0) >= address_threshold, trace))
+        if t >= tmin:
             if not trace:
-                print(f"""Invalid input line: '{s.strip()}'
-{expected_input_format}
-Please run `stall-analyser.py --help` for usage instruction""", file=sys.stderr)
-                sys.exit(1)
+                raise InvalidInputLine(s.strip())
             render.process_trace(trace, t)
 
+
+# the minimal size of the byte ranges of an input file processed by a --jobs worker
+MIN_JOB_RANGE_SIZE = 1 << 20
+
+
+def _read_range(path: str, begin: int, end: int) -> Iterator[bytes]:
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.seek(begin)
+        while mm.tell() < end:
+            yield mm.readline()
+
+
+def split_input(path: str, jobs: int) -> list[tuple[str, int, int]]:
+    # split an uncompressed file into byte ranges, each starting at a line
+    # boundary, for the --jobs workers to process, or keep it whole
+    # (an empty range) when it is compressed or not a regular file
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:4].startswith(addr2line.GZIP_MAGIC) or mm[:4] == addr2line.ZSTD_MAGIC:
+                return [(path, 0, 0)]
+            size = len(mm)
+            step = max(-(-size // jobs), MIN_JOB_RANGE_SIZE)
+            bounds = [0]
+            while bounds[-1] < size:
+                eol = mm.find(b'\n', bounds[-1] + step - 1)
+                bounds.append(size if eol < 0 else eol + 1)
+    except (ValueError, OSError):
+        # empty, or not mappable
+        return [(path, 0, 0)]
+    return [(path, begin, end) for begin, end in zip(bounds, bounds[1:])]
+
+
+def _process_input_range(path: str, begin: int, end: int, output_format: str, window: int, tmin: int, address_threshold: int) -> bytes:
+    # runs in a --jobs worker, returning the partial state of the range
+    lines = _read_range(path, begin, end) if end else addr2line.read_log_lines(path)
+    tally = {}
+    stats = StallStats(window)
+    render = Graph(None) if output_format == 'graph' else StackCollapse(None)
+    process_lines(lines, tally, stats, render, tmin, address_threshold)
+    return _state_payload(output_format, tally, stats, render)
+
+
+def process_files_parallel(paths: list[str], jobs: int, output_format: str, tally: dict, stats: StallStats, render, tmin: int, address_threshold: int) -> None:
+    ranges = [r for path in paths for r in split_input(path, jobs)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_process_input_range, path, begin, end, output_format, stats.window, tmin, address_threshold)
+                   for path, begin, end in ranges]
+        # merge the partial states in input order, so the graph is the same as when processed serially
+        for future in futures:
+            _merge_payload(memoryview(future.result()), output_format, tally, stats, render, '--jobs worker')
+
+
+class TestStallAnalyser(unittest.TestCase):
+
+    @staticmethod
+    def _log(n: int = 2000, seed: int = 42, called_outermost: bool = True) -> list[bytes]:
+        # stalls of a few backtraces, most of them repeated, over shards and
+        # minutes, with the outermost frame of some backtraces called in others
+        # unless called_outermost is False
+        rng = random.Random(seed)
+        traces = [' '.join(hex(rng.randrange(0x1000, 0x1010)) for _ in range(rng.randint(1, 6)))
+                  for _ in range(20)]
+        if not called_outermost:
+            traces = [f'{trace} {hex(0x2000 + i)}' for i, trace in enumerate(traces)]
+        lines = [b'# a comment\n']
+        for i in range(n):
+            timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(1700000000 + i * 7))
+            lines.append(f'{timestamp} scylla[1]: Reactor stalled for {rng.randint(1, 500)} ms on shard '
+                         f'{rng.randrange(4)}. Backtrace: {rng.choice(traces)}\n'.encode())
+        return lines
+
+    @staticmethod
+    def _parse(lines: list[bytes], render) -> tuple[dict, StallStats]:
+        tally = {}
+        stats = StallStats(60)
+        process_lines(lines, tally, stats, render, 0, 0x100000000)
+        return tally, stats
+
+    @staticmethod
+    def _output(tally: dict, stats: StallStats, graph: 'Graph') -> str:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            print_stats(tally, 0)
+            print_bucket_stats(stats, True, 3)
+            graph.print_graph('bottom-up', 0, 0.0)
+            graph.print_graph('top-down', 0, 0.0)
+        return output.getvalue()
+
+    @staticmethod
+    def _sketches(stats: StallStats) -> dict:
+        return {key: (sketch.bins, sketch.zeros, sketch.count, sketch.total, sketch.min, sketch.max)
+                for key, sketch in stats.buckets.items()}
+
+    def test_state_round_trip(self):
+        lines = self._log()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'state')
+            for output_format, render_type in (('graph', Graph), ('trace', StackCollapse)):
+                render = render_type(None)
+                tally, stats = self._parse(lines, render)
+                save_state(path, output_format, tally, stats, render)
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(len(STATE_MAGIC) + 4), STATE_MAGIC + struct.pack('<I', STATE_VERSION))
+                self.assertTrue(is_state(path))
+
+                loaded = render_type(None)
+                loaded_tally = {}
+                loaded_stats = StallStats(60)
+                load_state(path, output_format, loaded_tally, loaded_stats, loaded)
+                fresh = render_type(None)
+                fresh_tally, fresh_stats = self._parse(lines, fresh)
+                self.assertEqual(loaded_tally, fresh_tally)
+                self.assertEqual(self._sketches(loaded_stats), self._sketches(fresh_stats))
+                if output_format == 'graph':
+                    self.assertEqual(loaded.save(), fresh.save())
+                    self.assertEqual(self._output(loaded_tally, loaded_stats, loaded),
+                                     self._output(fresh_tally, fresh_stats, fresh))
+                else:
+                    self.assertEqual(list(loaded.collapsed.items()), list(fresh.collapsed.items()))
+
+                with self.assertRaisesRegex(ValueError, 'the state was saved with --format='):
+                    load_state(path, 'trace' if output_format == 'graph' else 'graph', {}, StallStats(), render_type(None))
+
+    def test_flamegraph_without_resolver(self):
+        collapse = StackCollapse(None)
+        self._parse(self._log(), collapse)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            collapse.print_flamegraph_html(0.0)
+        data = json.loads(re.search(r'const data = (.*);\n', output.getvalue()).group(1))
+        # the frames are named after the raw addresses
+        addrs = {addr for stack in collapse.collapsed for addr in stack.split(';')}
+        self.assertEqual(set(data['names']), addrs | {'all'})
+        self.assertEqual(data['tree'][1], sum(collapse.collapsed.values()))
+
+    def test_trace_diff_without_resolver(self):
+        base = StackCollapse(None)
+        self._parse(self._log(500, 1), base)
+        collapse = StackCollapse(None)
+        self._parse(self._log(500, 2), collapse)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            collapse.print_diff(base)
+        rows = [(stack, int(base_count), int(count))
+                for stack, base_count, count in (line.split() for line in output.getvalue().splitlines())]
+        # the stacks of raw addresses, from the outermost caller, with their
+        # count in the base and in this one, the largest regressions first
+        self.assertEqual({stack for stack, _, _ in rows},
+                         {';'.join(reversed(stack.split(';'))) for stack in base.collapsed.keys() | collapse.collapsed.keys()})
+        self.assertEqual(sum(base_count for _, base_count, _ in rows), sum(base.collapsed.values()))
+        self.assertEqual(sum(count for _, _, count in rows), sum(collapse.collapsed.values()))
+        regressions = [count - base_count for _, base_count, count in rows]
+        self.assertEqual(regressions, sorted(regressions, reverse=True))
+
+    def test_graph_aggregation(self):
+        class PerTraceGraph(Graph):
+            # inserts every backtrace into the graph as it is processed
+            __slots__ = ()
+
+            def process_trace(self, trace: list[str], t: int) -> None:
+                super().process_trace(trace, t)
+                self._build()
+
+        for seed in range(5):
+            for called_outermost in (True, False):
+                lines = self._log(500, seed, called_outermost)
+                aggregated = Graph(None)
+                tally, stats = self._parse(lines, aggregated)
+                per_trace = PerTraceGraph(None)
+                self._parse(lines, per_trace)
+                self.assertEqual(aggregated.link_totals(), per_trace.link_totals())
+                self.assertEqual(aggregated.node_totals(), per_trace.node_totals())
+                self.assertEqual(aggregated.edges, per_trace.edges)
+                self.assertEqual(self._output(tally, stats, aggregated), self._output(tally, stats, per_trace))
+
+
+def main():
+    parser = get_command_line_parser()
+    args = parser.parse_args()
+    if args.diff and args.format == 'flamegraph-html':
+        parser.error('--diff is not supported with --format=flamegraph-html, use --format=trace')
+    address_threshold = int(args.address_threshold, 0)
+    # map from stall time in ms to the count of the stall time
+    tally = {}
+    stats = StallStats(args.window)
+    resolver = None
+    if args.executable:
+        resolver = addr2line.BacktraceResolver(executable=args.executable,
+                                               concise=not args.full_function_names,
+                                               cmd_path=args.addr2line,
+                                               symbol_cache=args.symbol_cache_file if args.symbol_cache else None,
+                                               backend=args.backend,
+                                               max_resolvers=args.max_resolvers,
+                                               server=args.server)
+    if args.format == 'graph':
+        render = Graph(resolver)
+    else:
+        render = StackCollapse(resolver)
+    # the format of the saved states: the flame graph is built from the
+    # collapsed stacks of the trace format
+    state_format = 'graph' if args.format == 'graph' else 'trace'
+
+    for path in args.load_state or []:
+        try:
+            load_state(path, state_format, tally, stats, render)
+        except (OSError, ValueError, struct.error, zlib.error) as e:
+            print(f"Failed to load state: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    paths = args.file
+    if not paths and not args.load_state:
+        paths = ['-']
+    try:
+        if args.jobs > 1 and '-' not in paths:
+            process_files_parallel(paths, args.jobs, state_format, tally, stats, render, args.tmin, address_threshold)
+        else:
+            for path in paths:
+                lines = addr2line.read_log_lines(path if path != '-' else sys.stdin.buffer)
+                process_lines(lines, tally, stats, render, args.tmin, address_threshold)
+    except InvalidInputLine as e:
+        print(f"""Invalid input line: '{e}'
+{EXPECTED_INPUT_FORMAT}
+Please run `stall-analyser.py --help` for usage instruction""", file=sys.stderr)
+        sys.exit(1)
+
+    if args.save_state:
+        save_state(args.save_state, state_format, tally, stats, render)
+
+    baseline = None
+    if args.diff:
+        baseline = type(render)(resolver)
+        baseline_tally = {}
+        try:
+            if is_state(args.diff):
+                load_state(args.diff, state_format, baseline_tally, StallStats(), baseline)
+            else:
+                lines = addr2line.read_log_lines(args.diff)
+                process_lines(lines, baseline_tally, StallStats(), baseline, args.tmin, address_threshold)
+        except (OSError, ValueError, struct.error, zlib.error) as e:
+            print(f"Failed to load the baseline: {e}", file=sys.stderr)
+            sys.exit(1)
+        except InvalidInputLine as e:
+            print(f"Invalid baseline line: '{e}'\n{EXPECTED_INPUT_FORMAT}", file=sys.stderr)
+            sys.exit(1)
+
     try:
         if not render:
             print(f"""No input data found.
-{expected_input_format}
+{EXPECTED_INPUT_FORMAT}
 Please run `stall-analyser.py --help` for usage instruction""", file=sys.stderr)
             sys.exit(1)
         if args.format == 'graph':
             print_command_line_options(args)
             print_stats(tally, args.tmin)
-        render.print_graph(args.direction, args.width, args.branch_threshold)
+            print_bucket_stats(stats, args.shard_stats, args.top)
+            if baseline is not None:
+                print("\nBaseline:")
+                print_stats(baseline_tally, args.tmin)
+        if baseline is not None:
+            render.print_diff(baseline, args.width)
+        elif args.format == 'flamegraph-html':
+            render.print_flamegraph_html(args.min_width)
+        else:
+            render.print_graph(args.direction, args.width, args.branch_threshold)
     except BrokenPipeError:
         pass
 
 
 if __name__ == '__main__':
-    main()
+    cmdline_parser = argparse.ArgumentParser(add_help=False)
+    cmdline_parser.add_argument('-t', '--test', action='store_true', default=False, help='Self-test')
+    args, unrecognized = cmdline_parser.parse_known_args()
+
+    if args.test:
+        unittest.main(argv=[sys.argv[0]] + unrecognized)
+    else:
+        main()